@@ -19,6 +19,23 @@ class db:
 	def _execute(self, query, params=None, cb=None):
 		if params is None:
 			params = ()
+
+		def run(conn, cur):
+			log.debug("{} ({})".format(query, params))
+			cur.execute(query, params)
+			if callable(cb):
+				return cb(cur)
+			return None
+		return self._run(run)
+
+	def _run(self, f):
+		"""
+		Call `f(conn, cur)` with the current thread's connection and a new cursor,
+		recovering from operational/internal errors up to `self.maxAttempts` times.
+
+		:param f: function that accepts a connection and a cursor
+		:return: `f`'s return value
+		"""
 		attempts = 0
 		result = None
 		lastExc = None
@@ -32,10 +49,7 @@ class db:
 				conn = objects.glob.threadScope.db
 				cur = conn.cursor(pymysql.cursors.DictCursor)
 
-				log.debug("{} ({})".format(query, params))
-				cur.execute(query, params)
-				if callable(cb):
-					result = cb(cur)
+				result = f(conn, cur)
 
 				# Clear any exception we may have due to previously
 				# failed attempts to execute the query
@@ -81,3 +95,29 @@ class db:
 
 	def fetchAll(self, query, params=None):
 		return self._execute(query=query, params=params, cb=lambda x: x.fetchall())
+
+	def transaction(self, queries):
+		"""
+		Execute some queries in a single transaction.
+		If any of them fails, the whole transaction is rolled back.
+
+		:param queries: list of (query, params) tuples
+		:return: lastrowid of the last query
+		"""
+		def run(conn, cur):
+			conn.begin()
+			try:
+				for query, params in queries:
+					log.debug("{} ({})".format(query, params))
+					cur.execute(query, params)
+				conn.commit()
+			except:
+				# The connection may be gone already, in that case
+				# the server rolls back the transaction by itself
+				try:
+					conn.rollback()
+				except:
+					pass
+				raise
+			return cur.lastrowid
+		return self._run(run)
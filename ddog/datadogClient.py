@@ -54,6 +54,17 @@ class datadogClient:
 		if self.client is not None:
 			self.client.gauge(*args, **kwargs)
 
+	def histogram(self, *args, **kwargs):
+		"""
+		Call self.client.histogram(*args, **kwargs) if this client is not a dummy
+
+		:param args:
+		:param kwargs:
+		:return:
+		"""
+		if self.client is not None:
+			self.client.histogram(*args, **kwargs)
+
 	def __periodicCheckLoop(self):
 		"""
 		Report periodic data to datadog.
@@ -1,23 +1,243 @@
+import atexit
+import gzip
+import os
+import signal
+import struct
+import threading
+import time
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+from common.log import logUtils as log
+from common.sentry import sentry
 from objects import glob
 
+# Max number of buffers passed to a single os.writev call
+_IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") and "SC_IOV_MAX" in os.sysconf_names else 1024
+
+def _writeAll(fd, chunks):
+	"""
+	Write some chunks to a file descriptor, with as few syscalls as possible
+
+	:param fd: file descriptor
+	:param chunks: list of bytes
+	:return:
+	"""
+	if not hasattr(os, "writev"):
+		chunks = [b"".join(chunks)]
+	i = 0
+	while i < len(chunks):
+		if hasattr(os, "writev"):
+			written = os.writev(fd, chunks[i:i + _IOV_MAX])
+		else:
+			written = os.write(fd, chunks[i])
+
+		# Skip what has been written, and retry with the rest (partial writes)
+		while i < len(chunks) and written >= len(chunks[i]):
+			written -= len(chunks[i])
+			i += 1
+		if written > 0:
+			chunks[i] = chunks[i][written:]
+
+class compressedWriter:
+	"""
+	Append-only writer that compresses every flush as an independent gzip member or zstd frame.
+	Concatenated members/frames are a valid gzip/zstd file, so the file stays
+	readable (up to the last complete frame) even after a crash.
+	The file is rotated by size and/or time, and every frame's offset is recorded in
+	an index file (`<file>.idx`), so the latest data can be read without decompressing the whole file.
+	`write` must be called with the file (`self.fileName`) locked through `glob.fLocks`, which
+	`buffer.flush` does. Offsets and rotation are based on the file itself, not on per-process state,
+	so processes sharing the file through cross-process locks (`fileLocks(crossProcess=True)`) are safe.
+	"""
+	# Index record: frame offset, compressed length, uncompressed length
+	INDEX_RECORD = struct.Struct("<QQQ")
+
+	def __init__(self, fileName, compression="gzip", level=None, rotateSize=None, rotateInterval=None):
+		"""
+		Initialize a compressed writer
+
+		:param fileName: Path and name of file on disk, without the compression extension.
+		:param compression: "gzip" or "zstd" (requires zstandard). Default: "gzip".
+		:param level: compression level. Optional. Default: 6 for gzip, 3 for zstd.
+		:param rotateSize: rotate the file when it's bigger than this many bytes. Optional.
+		:param rotateInterval: rotate the file when a new `rotateInterval` seconds window
+							   (aligned to the UNIX epoch, eg: 3600 rotates every hour) starts. Optional.
+		"""
+		if compression == "gzip":
+			level = 6 if level is None else level
+			self.compress = lambda x: gzip.compress(x, compresslevel=level)
+			self.decompress = gzip.decompress
+			self.extension = ".gz"
+		elif compression == "zstd":
+			if zstandard is None:
+				raise RuntimeError("zstd compression requires zstandard")
+			level = 3 if level is None else level
+			self.compress = zstandard.ZstdCompressor(level=level).compress
+			self.decompress = lambda x: zstandard.ZstdDecompressor().decompress(x)
+			self.extension = ".zst"
+		else:
+			raise ValueError("Unsupported compression ({})".format(compression))
+		self.fileName = fileName + self.extension
+		self.indexFileName = self.fileName + ".idx"
+		self.rotateSize = rotateSize
+		self.rotateInterval = rotateInterval
+		self.fd = None
+		self.indexFd = None
+
+	def _open(self):
+		"""
+		Open the data and index files, if they're not open already.
+		Reopens them if another process has rotated them.
+
+		:return:
+		"""
+		if self.fd is not None:
+			try:
+				rotated = os.stat(self.fileName).st_ino != os.fstat(self.fd).st_ino
+			except FileNotFoundError:
+				rotated = True
+			if not rotated:
+				return
+			self.close()
+		flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+		self.fd = os.open(self.fileName, flags, 0o644)
+		self.indexFd = os.open(self.indexFileName, flags, 0o644)
+
+	def close(self):
+		"""
+		Close the data and index files
+
+		:return:
+		"""
+		if self.fd is not None:
+			os.close(self.fd)
+			os.close(self.indexFd)
+			self.fd = None
+			self.indexFd = None
+
+	def write(self, chunks):
+		"""
+		Compress some chunks into a single frame and append it to the file.
+		Rotates the file first, if needed. The file must be locked.
+
+		:param chunks: list of bytes
+		:return:
+		"""
+		data = b"".join(chunks)
+		frame = self.compress(data)
+		self._open()
+		stat = os.fstat(self.fd)
+		if self._shouldRotate(stat):
+			self.rotate()
+			self._open()
+			stat = os.fstat(self.fd)
+		_writeAll(self.fd, [frame])
+		_writeAll(self.indexFd, [self.INDEX_RECORD.pack(stat.st_size, len(frame), len(data))])
+
+	def _shouldRotate(self, stat):
+		if stat.st_size == 0:
+			return False
+		if self.rotateSize is not None and stat.st_size >= self.rotateSize:
+			return True
+		if self.rotateInterval is not None and stat.st_mtime // self.rotateInterval < time.time() // self.rotateInterval:
+			return True
+		return False
+
+	def rotate(self):
+		"""
+		Move the current file (and its index) to `<file>.<timestamp>` and start a new one.
+		The file must be locked.
+
+		:return:
+		"""
+		self.close()
+		base, extension = self.fileName[:-len(self.extension)], self.extension
+		# Microseconds keep names unique and sortable when rotating often
+		now = time.time()
+		rotatedName = "{}.{}-{:06d}{}".format(
+			base, time.strftime("%Y%m%d-%H%M%S", time.localtime(now)), int(now % 1 * 1000000), extension
+		)
+		os.rename(self.fileName, rotatedName)
+		if os.path.exists(self.indexFileName):
+			os.rename(self.indexFileName, rotatedName + ".idx")
+		log.debug("Rotated {} to {}".format(self.fileName, rotatedName))
+
+	def tail(self, frames=1):
+		"""
+		Return the uncompressed content of the last `frames` frames of the current file,
+		using the index to read only them
+
+		:param frames: number of frames. Default: 1.
+		:return: bytes
+		"""
+		recordSize = self.INDEX_RECORD.size
+		try:
+			with open(self.indexFileName, "rb") as f:
+				f.seek(0, os.SEEK_END)
+				# Ignore a partially written record at the end
+				end = f.tell() - f.tell() % recordSize
+				start = max(0, end - frames * recordSize)
+				f.seek(start)
+				index = f.read(end - start)
+		except FileNotFoundError:
+			return b""
+		records = [self.INDEX_RECORD.unpack_from(index, i) for i in range(0, len(index), recordSize)]
+		if not records:
+			return b""
+		result = []
+		with open(self.fileName, "rb") as f:
+			for offset, length, _ in records:
+				f.seek(offset)
+				result.append(self.decompress(f.read(length)))
+		return b"".join(result)
+
 class buffer:
 	"""
 	A file buffer object.
 	This buffer caches data in memory and when it's full, it writes the content to a file.
 	"""
-	def __init__(self, fileName, writeType="a", maxLength=512):
+	def __init__(self, fileName, writeType="a", maxLength=65536, maxAge=None, writer=None, sizeCallback=None):
 		"""
 		A file buffer object
 
 		:param fileName: Path and name of file on disk .
 		:param writeType: File write type. Optional. Default: "a" .
-		:param maxLength: Max length before writing buffer to disk. Optional. Default: 512.
+						  "a" appends to the file, "w" replaces its content on every flush.
+		:param maxLength: Max length in bytes before writing buffer to disk. Optional. Default: 65536.
+		:param maxAge: Max seconds data can stay in the buffer. Optional. Default: no limit.
+					   Enforced by buffersList's background flusher.
+		:param writer: object that writes the flushed chunks instead of appending them
+					   to `fileName` (eg: a `compressedWriter`). Optional. `writeType` is ignored if set.
+		:param sizeCallback: function called with the change in buffered bytes on every write and flush. Optional.
 		"""
-		self.content = ""
+		self.chunks = []
 		self.length = 0
+		self.firstWriteTime = None
 		self.fileName = fileName
 		self.writeType = writeType
 		self.maxLength = maxLength
+		self.maxAge = maxAge
+		self.fd = None
+		self.writer = writer
+		# Lock the file that is actually written
+		self.lockName = writer.fileName if writer is not None else fileName
+		self.sizeCallback = sizeCallback
+		self._lock = threading.Lock()
+		# Held across chunks swap and write, so flushes reach the file in order
+		self._flushLock = threading.Lock()
+
+	@property
+	def content(self):
+		"""
+		Buffered data, as a string
+
+		:return:
+		"""
+		return b"".join(self.chunks).decode("utf-8")
 
 	def write(self, newData):
 		"""
@@ -25,36 +245,149 @@ class buffer:
 		If the total length of the data in buffer is greater than or equal to self.maxLength,
 		the content is written on the disk and the buffer resets
 
-		:param newData: Data to append to buffer
+		:param newData: Data to append to buffer. str (encoded as utf-8) or bytes.
 		:return:
 		"""
-		self.content += newData
-		self.length += len(newData)
-		if self.length >= self.maxLength:
+		if type(newData) is str:
+			newData = newData.encode("utf-8")
+		with self._lock:
+			if not self.chunks:
+				self.firstWriteTime = time.monotonic()
+			self.chunks.append(newData)
+			self.length += len(newData)
+			full = self.length >= self.maxLength
+		if self.sizeCallback is not None:
+			self.sizeCallback(len(newData))
+		if full:
 			self.flush()
 
+	def age(self):
+		"""
+		Return how many seconds the oldest buffered data has been waiting
+
+		:return: seconds, 0 if the buffer is empty
+		"""
+		firstWriteTime = self.firstWriteTime
+		if firstWriteTime is None:
+			return 0
+		return time.monotonic() - firstWriteTime
+
+	def _open(self):
+		"""
+		Open the file, if it's not open already.
+		Reopens it if it's been renamed or deleted (eg: by logrotate), so the live path is recreated.
+
+		:return: file descriptor
+		"""
+		if self.fd is not None:
+			try:
+				rotated = os.stat(self.fileName).st_ino != os.fstat(self.fd).st_ino
+			except FileNotFoundError:
+				rotated = True
+			if rotated:
+				os.close(self.fd)
+				self.fd = None
+		if self.fd is None:
+			flags = os.O_WRONLY | os.O_CREAT
+			if "a" in self.writeType:
+				flags |= os.O_APPEND
+			self.fd = os.open(self.fileName, flags, 0o644)
+		return self.fd
+
+	def _writeChunks(self, chunks):
+		"""
+		Write some chunks to the file, with as few syscalls as possible
+
+		:param chunks: list of bytes
+		:return:
+		"""
+		if self.writer is not None:
+			self.writer.write(chunks)
+			return
+		fd = self._open()
+		if "a" not in self.writeType:
+			# "w" mode, replace the file content
+			os.ftruncate(fd, 0)
+			os.lseek(fd, 0, os.SEEK_SET)
+		_writeAll(fd, chunks)
+
 	def flush(self):
 		"""
 		Write buffer content to disk and reset its content
 
 		:return:
 		"""
-		try:
-			glob.fLocks.lockFile(self.fileName)
-			with open(self.fileName, self.writeType) as f:
-				f.write(self.content)
-		finally:
-			glob.fLocks.unlockFile(self.fileName)
+		with self._flushLock:
+			with self._lock:
+				chunks = self.chunks
+				length = self.length
+				self.chunks = []
+				self.length = 0
+				self.firstWriteTime = None
+			if not chunks:
+				return
+			if self.sizeCallback is not None:
+				self.sizeCallback(-length)
+			start = time.perf_counter()
+			with glob.fLocks.lock(self.lockName):
+				self._writeChunks(chunks)
+		glob.dog.histogram(glob.DATADOG_PREFIX + ".file_buffers.flush_latency", time.perf_counter() - start)
 
-		self.content = ""
-		self.length = 0
+	def close(self):
+		"""
+		Flush the buffer and close the file
+
+		:return:
+		"""
+		self.flush()
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+		if self.writer is not None:
+			self.writer.close()
 
 class buffersList:
 	"""
 	A list of buffers
 	"""
-	def __init__(self):
+	def __init__(
+		self, maxAge=None, maxMemory=None, flushInterval=1,
+		compression=None, compressionLevel=None, rotateSize=None, rotateInterval=None
+	):
+		"""
+		A list of buffers.
+		All buffers are flushed when the process exits.
+
+		:param maxAge: Max seconds data can stay in a buffer before a background thread flushes it.
+					   Used for new buffers, can be changed for a single buffer through its `maxAge` attribute.
+					   Optional. Default: no limit (no background flushing, unless a buffer has its own `maxAge`).
+		:param maxMemory: Max bytes buffered across all buffers. When exceeded, the largest buffers
+						  are flushed first until the total is under the limit. Optional. Default: no limit.
+						  Starts the background thread too, to report the buffered bytes.
+		:param flushInterval: Seconds between background flusher checks. Default: 1.
+		:param compression: if set ("gzip" or "zstd"), buffers are written through a `compressedWriter`,
+							one frame per flush. Optional. Default: no compression.
+		:param compressionLevel: compression level. Optional.
+		:param rotateSize: compressed files rotation size, in bytes. Optional.
+		:param rotateInterval: compressed files rotation interval, in seconds. Optional.
+		"""
 		self.buffers = {}
+		self.maxAge = maxAge
+		self.maxMemory = maxMemory
+		self.flushInterval = flushInterval
+		self.compression = compression
+		self.compressionLevel = compressionLevel
+		self.rotateSize = rotateSize
+		self.rotateInterval = rotateInterval
+		self._lock = threading.Lock()
+		self._pendingBytes = 0
+		self._pendingLock = threading.Lock()
+		self._flusher = None
+		self._previousSignalHandlers = {}
+		self._signalFlushTimeout = 5
+		atexit.register(self.flushAll)
+		if maxAge is not None or maxMemory is not None:
+			self.startFlusher()
 
 	def write(self, fileName, content):
 		"""
@@ -66,8 +399,46 @@ class buffersList:
 		:return:
 		"""
 		if fileName not in self.buffers:
-			self.buffers[fileName] = buffer(fileName)
+			with self._lock:
+				if fileName not in self.buffers:
+					writer = None
+					if self.compression is not None:
+						writer = compressedWriter(
+							fileName, self.compression, self.compressionLevel, self.rotateSize, self.rotateInterval
+						)
+					self.buffers[fileName] = buffer(
+						fileName, maxAge=self.maxAge, writer=writer, sizeCallback=self._addPendingBytes
+					)
 		self.buffers[fileName].write(content)
+		if self.maxMemory is not None and self._pendingBytes > self.maxMemory:
+			self.flushLargest()
+
+	def _addPendingBytes(self, delta):
+		with self._pendingLock:
+			self._pendingBytes += delta
+
+	def pendingBytes(self):
+		"""
+		Return the number of bytes buffered across all buffers
+
+		:return: bytes
+		"""
+		return self._pendingBytes
+
+	def flushLargest(self):
+		"""
+		Flush the largest buffers until the total buffered size is under `self.maxMemory`
+
+		:return:
+		"""
+		buffers = sorted(self.buffers.values(), key=lambda x: x.length, reverse=True)
+		total = sum(x.length for x in buffers)
+		for b in buffers:
+			if total <= self.maxMemory:
+				break
+			total -= b.length
+			b.flush()
+		glob.dog.gauge(glob.DATADOG_PREFIX + ".file_buffers.pending_bytes", self.pendingBytes())
 
 	def flushAll(self):
 		"""
@@ -75,5 +446,75 @@ class buffersList:
 
 		:return:
 		"""
-		for _, value in self.buffers.items():
-			value.flush()
\ No newline at end of file
+		for value in list(self.buffers.values()):
+			value.flush()
+
+	def flushExpired(self):
+		"""
+		Flush the buffers whose data is older than their `maxAge`
+
+		:return:
+		"""
+		for value in list(self.buffers.values()):
+			if value.maxAge is not None and value.age() >= value.maxAge:
+				value.flush()
+		glob.dog.gauge(glob.DATADOG_PREFIX + ".file_buffers.pending_bytes", self.pendingBytes())
+
+	def startFlusher(self):
+		"""
+		Start the background thread that flushes expired buffers and reports the buffered bytes.
+		Called automatically if `maxAge` or `maxMemory` are set.
+
+		:return:
+		"""
+		if self._flusher is not None:
+			return
+		self._flusher = threading.Thread(target=self._flusherLoop, daemon=True)
+		self._flusher.start()
+
+	@sentry.capture()
+	def _checkExpired(self):
+		self.flushExpired()
+
+	def _flusherLoop(self):
+		"""
+		Flush expired buffers every `self.flushInterval` seconds.
+		Runs forever.
+
+		:return:
+		"""
+		while True:
+			time.sleep(self.flushInterval)
+			self._checkExpired()
+
+	def installSignalHandlers(self, signals=(signal.SIGTERM, signal.SIGINT), timeout=5):
+		"""
+		Flush all buffers when the process receives one of `signals`, then run the previous handler.
+		Must be called from the main thread.
+
+		:param signals: signals to handle. Default: SIGTERM and SIGINT.
+		:param timeout: max seconds to wait for the flush before running the previous handler. Default: 5.
+		:return:
+		"""
+		self._signalFlushTimeout = timeout
+		for sig in signals:
+			self._previousSignalHandlers[sig] = signal.signal(sig, self._signalHandler)
+
+	def _signalHandler(self, signum, frame):
+		log.info("Received signal {}, flushing file buffers".format(signum))
+		# Flush from another thread: the interrupted code may be holding a buffer or file lock
+		flusher = threading.Thread(target=self.flushAll, daemon=True)
+		flusher.start()
+		flusher.join(self._signalFlushTimeout)
+		if flusher.is_alive():
+			# Most likely waiting for a lock held by the interrupted code.
+			# Unwind it, so the lock is released and the atexit flush can complete.
+			log.warning("File buffers flush is taking too long, exiting")
+			raise SystemExit(128 + signum)
+		previous = self._previousSignalHandlers.get(signum)
+		if callable(previous):
+			previous(signum, frame)
+		elif previous == signal.SIG_DFL:
+			# Restore the default behaviour (eg: terminate) and raise the signal again
+			signal.signal(signum, signal.SIG_DFL)
+			os.kill(os.getpid(), signum)
@@ -1,9 +1,48 @@
+import contextlib
+import os
 import threading
+import time
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+from objects import glob
 
 class fileLocks:
-	def __init__(self):
-		# Dictionary containing threading.Lock s
-		self.locks = {}
+	def __init__(self, stripes=64, crossProcess=False):
+		"""
+		A fixed-size table of locks. Each file name is hashed to one of `stripes` locks,
+		so the table never grows and there's no race when locking a file for the first time.
+		Locks are reentrant, so a thread can lock two files that hash to the same lock
+		(or the same file twice), as long as it unlocks them as many times.
+
+		:param stripes: number of locks. Default: 64.
+		:param crossProcess: if True, lock the files with flock(2) as well, so other processes
+							 that do the same (eg: pre-forked workers) are excluded too.
+							 Requires fcntl (unix only). Default: False.
+		"""
+		if crossProcess and fcntl is None:
+			raise RuntimeError("Cross process file locks require fcntl")
+		self.locks = [threading.RLock() for _ in range(stripes)]
+		self.crossProcess = crossProcess
+		# File descriptors of flock-ed files. Only the thread holding
+		# the file's stripe lock can access its entry.
+		self.fds = {}
+		# Per thread {path: lock depth} of the files locked by that thread
+		self._held = threading.local()
+		self.acquisitions = 0
+		self.contentions = 0
+
+	def _stripe(self, path):
+		return self.locks[hash(path) % len(self.locks)]
+
+	def _heldFiles(self):
+		held = getattr(self._held, "files", None)
+		if held is None:
+			held = self._held.files = {}
+		return held
 
 	def lockFile(self, fileName):
 		"""
@@ -12,21 +51,87 @@ class fileLocks:
 		:param fileName: file name
 		:return:
 		"""
-		if fileName in self.locks:
-			# Acquire existing lock
-			self.locks[fileName].acquire()
-		else:
-			# Create new lock and acquire it
-			self.locks[fileName] = threading.Lock()
-			self.locks[fileName].acquire()
+		path = os.path.abspath(fileName)
+		stripe = self._stripe(path)
+		self.acquisitions += 1
+		if not stripe.acquire(blocking=False):
+			# Someone else is holding this lock, wait for it and track it
+			self.contentions += 1
+			start = time.perf_counter()
+			stripe.acquire()
+			glob.dog.increment(glob.DATADOG_PREFIX + ".file_locks.contentions")
+			glob.dog.histogram(glob.DATADOG_PREFIX + ".file_locks.wait", time.perf_counter() - start)
+		held = self._heldFiles()
+		depth = held.get(path, 0)
+		if self.crossProcess and depth == 0:
+			# Flock it only the first time, flock-ing it again through another fd would deadlock
+			try:
+				self.fds[path] = self._flock(fileName)
+			except:
+				stripe.release()
+				raise
+		held[path] = depth + 1
+
+	@staticmethod
+	def _flock(fileName):
+		"""
+		Open and flock a file.
+		If the file is renamed (eg: rotated) while waiting for the lock, lock the new one instead.
+
+		:param fileName: file name
+		:return: file descriptor
+		"""
+		while True:
+			fd = os.open(fileName, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+			try:
+				fcntl.flock(fd, fcntl.LOCK_EX)
+				try:
+					current = os.stat(fileName).st_ino
+				except FileNotFoundError:
+					current = None
+			except:
+				os.close(fd)
+				raise
+			if current == os.fstat(fd).st_ino:
+				return fd
+			os.close(fd)
 
 	def unlockFile(self, fileName):
 		"""
-		Unlock a previously locked file
+		Unlock a previously locked file.
+		Does nothing if the file is not locked by this thread.
+
+		:param fileName: file name
+		:return:
+		"""
+		path = os.path.abspath(fileName)
+		held = self._heldFiles()
+		depth = held.get(path, 0)
+		if depth == 0:
+			return
+		if depth == 1:
+			del held[path]
+			if self.crossProcess:
+				# Closing the file releases the flock
+				os.close(self.fds.pop(path))
+		else:
+			held[path] = depth - 1
+		self._stripe(path).release()
+
+	@contextlib.contextmanager
+	def lock(self, fileName):
+		"""
+		Lock a file for the duration of a `with` block:
+		```
+		with glob.fLocks.lock("file.txt"):
+			...
+		```
 
 		:param fileName: file name
 		:return:
 		"""
-		if fileName in self.locks:
-			# Release lock if it exists
-			self.locks[fileName].release()
+		self.lockFile(fileName)
+		try:
+			yield
+		finally:
+			self.unlockFile(fileName)
@@ -1,7 +1,10 @@
+import os
 import string
 import random
 import hashlib
-from functools import partial
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from common.log import logUtils as log
 
 import dill
@@ -21,18 +24,119 @@ def stringToBool(s):
 	"""
 	return s == "True" or s == "true" or s == "1" or s == 1
 
-def fileMd5(filename):
+# Read size used when hashlib.file_digest is not available
+_HASH_BUFFER_SIZE = 1024 * 1024
+
+class md5Cache:
+	"""
+	Persistent cache of files md5, stored in a sqlite database.
+	Entries are keyed by (device, inode, size, mtime_ns), so a file is hashed
+	again only if it has been modified (or replaced).
+	"""
+	def __init__(self, path):
+		"""
+		Open (or create) an md5 cache
+
+		:param path: sqlite database path
+		"""
+		self._lock = threading.Lock()
+		self.conn = sqlite3.connect(path, check_same_thread=False)
+		self.conn.execute(
+			"CREATE TABLE IF NOT EXISTS md5_cache ("
+			"dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, md5 TEXT, "
+			"PRIMARY KEY (dev, ino))"
+		)
+		self.conn.commit()
+
+	def get(self, stat):
+		"""
+		Return the cached md5 of a file
+
+		:param stat: os.stat_result of the file
+		:return: md5 or None if it's not cached or the file has changed
+		"""
+		with self._lock:
+			row = self.conn.execute(
+				"SELECT md5 FROM md5_cache WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+				(stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+			).fetchone()
+		return row[0] if row is not None else None
+
+	def set(self, stat, md5):
+		"""
+		Cache a file's md5
+
+		:param stat: os.stat_result of the file
+		:param md5: file md5
+		:return:
+		"""
+		with self._lock:
+			self.conn.execute(
+				"REPLACE INTO md5_cache (dev, ino, size, mtime_ns, md5) VALUES (?, ?, ?, ?, ?)",
+				(stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, md5)
+			)
+			self.conn.commit()
+
+	def close(self):
+		with self._lock:
+			self.conn.close()
+
+def _statKey(stat):
+	return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+def fileMd5(filename, cache=None):
 	"""
 	Return filename's md5
 
 	:param filename: name of the file
+	:param cache: md5Cache object. Optional. If passed, unchanged files are not hashed again.
 	:return: file md5
 	"""
 	with open(filename, mode='rb') as f:
-		d = hashlib.md5()
-		for buf in iter(partial(f.read, 128), b''):
-			d.update(buf)
-	return d.hexdigest()
+		stat = None
+		if cache is not None:
+			stat = os.fstat(f.fileno())
+			cached = cache.get(stat)
+			if cached is not None:
+				return cached
+		if hasattr(hashlib, "file_digest"):
+			# Python 3.11+, reads the file in big chunks without holding the GIL
+			d = hashlib.file_digest(f, "md5")
+		else:
+			d = hashlib.md5()
+			buf = bytearray(_HASH_BUFFER_SIZE)
+			view = memoryview(buf)
+			while True:
+				n = f.readinto(buf)
+				if not n:
+					break
+				d.update(view[:n])
+		result = d.hexdigest()
+		if cache is not None and _statKey(os.fstat(f.fileno())) == _statKey(stat):
+			# Cache the result only if the file hasn't changed while we were hashing it
+			cache.set(stat, result)
+	return result
+
+def fileMd5Many(paths, workers=None, cache=None):
+	"""
+	Return the md5 of many files, hashing them in parallel.
+	hashlib releases the GIL while hashing, so threads are enough.
+
+	:param paths: iterable of file names
+	:param workers: number of threads. Optional. Default: ThreadPoolExecutor's default.
+	:param cache: md5Cache object. Optional.
+	:return: dictionary {file name: md5}. md5 is None if the file couldn't be read.
+	"""
+	def f(path):
+		try:
+			return fileMd5(path, cache)
+		except OSError as e:
+			log.warning("Could not hash {} ({})".format(path, e))
+			return None
+
+	paths = list(paths)
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		return dict(zip(paths, executor.map(f, paths)))
 
 def stringMd5(s):
 	"""
@@ -64,7 +64,8 @@ def rap(userID, message, discordChannel=None, through="FokaBot"):
 	import common.ripple
 	import objects.glob
 	objects.glob.db.execute("INSERT INTO rap_logs (id, userid, text, datetime, through) VALUES (NULL, %s, %s, %s, %s)", [userID, message, int(time.time()), through])
-	username = common.ripple.userUtils.getUsername(userID)
+	state = common.ripple.userUtils.getUsersState(userID)
+	username = state["username"] if state is not None else None
 	if discordChannel is not None:
 		discord(discordChannel, "{} {}".format(username, message))
 
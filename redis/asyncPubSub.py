@@ -0,0 +1,108 @@
+import asyncio
+import inspect
+import time
+
+from tornado.ioloop import IOLoop
+
+from common.log import logUtils as log
+from common.redis import generalPubSubHandler
+from common.sentry import sentry
+from objects import glob
+
+class asyncListener:
+	def __init__(self, r, handlers, executor=None):
+		"""
+		Initialize a set of redis pubSub listeners running on the asyncio/tornado event loop.
+		Unlike `common.redis.pubSub.listener`, this doesn't need a dedicated thread.
+
+		:param r: redis.asyncio.Redis instance (requires redis-py >= 4.2)
+		:param handlers: same as `common.redis.pubSub.listener`. Handlers can also be
+						 `async def` functions or generalPubSubHandler objects with an `async def handle` method,
+						 that are awaited on the event loop. Sync handlers are run in `executor`.
+		:param executor: concurrent.futures executor used to run sync handlers.
+						 Optional. Default: the event loop's default executor.
+		"""
+		self.redis = r
+		self.pubSub = self.redis.pubsub()
+		self.handlers = handlers
+		self.executor = executor
+		self.running = False
+
+	def start(self):
+		"""
+		Start listening on the current tornado IOLoop
+
+		:return:
+		"""
+		IOLoop.current().spawn_callback(self.run)
+
+	async def stop(self):
+		"""
+		Stop listening and close the pubsub connection
+
+		:return:
+		"""
+		self.running = False
+		await self.pubSub.unsubscribe()
+		await self.pubSub.close()
+
+	async def run(self):
+		"""
+		Listen for data on incoming channels and process it.
+		Runs until `stop()` is called.
+
+		:return:
+		"""
+		channels = list(self.handlers.keys())
+		await self.pubSub.subscribe(*channels)
+		log.debug("Subscribed to redis pubsub channels (async): {}".format(channels))
+		self.running = True
+		async for item in self.pubSub.listen():
+			if not self.running:
+				break
+			await self.processItem(item)
+
+	@sentry.captureAsync()
+	async def processItem(self, item):
+		"""
+		Processes a pubSub item by calling channel's handler
+
+		:param item: incoming data
+		:return:
+		"""
+		if item["type"] != "message":
+			return
+		channel = item["channel"]
+		if type(channel) is bytes:
+			channel = channel.decode("utf-8")
+		if channel not in self.handlers:
+			return
+		log.info("Redis pubsub: {} <- {} ".format(channel, item["data"]))
+		await self.handle(channel, item["data"])
+
+	async def handle(self, channel, data):
+		"""
+		Call `channel`'s handler with `data`.
+		Coroutine handlers are awaited, sync handlers run in the executor.
+
+		:param channel: channel name
+		:param data: raw data
+		:return:
+		"""
+		handler = self.handlers[channel]
+		if isinstance(handler, generalPubSubHandler.generalPubSubHandler):
+			# Handler class
+			handler = handler.handle
+
+		start = time.perf_counter()
+		try:
+			if inspect.iscoroutinefunction(handler):
+				await handler(data)
+			else:
+				await asyncio.get_event_loop().run_in_executor(self.executor, handler, data)
+		finally:
+			glob.dog.histogram(
+				glob.DATADOG_PREFIX + ".pubsub.handler_latency",
+				time.perf_counter() - start,
+				tags=["channel:{}".format(channel)]
+			)
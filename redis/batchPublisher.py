@@ -0,0 +1,111 @@
+import atexit
+import threading
+import time
+
+from common.log import logUtils as log
+from common.redis import streams
+from common.sentry import sentry
+from objects import glob
+
+class batchPublisher:
+	"""
+	Buffers pubsub messages for a few milliseconds and publishes them with a single redis pipeline.
+	Messages on the same channel are published in order. Use `flush()` if you need
+	the messages to be published before doing something else.
+	"""
+	def __init__(self, r=None, interval=0.005, coalesceChannels=None, maxBatch=1000):
+		"""
+		Initialize a batch publisher. Its flusher thread is started when the first message is published.
+
+		:param r: redis instance. Optional. Default: glob.redis.
+		:param interval: seconds a message can wait in the buffer. Default: 0.005.
+		:param coalesceChannels: channels where duplicate messages in the same batch are published only once.
+								 Optional. Default: no channels.
+		:param maxBatch: number of buffered messages that triggers an immediate flush. Default: 1000.
+		"""
+		self.redis = r
+		self.interval = interval
+		self.coalesceChannels = set(coalesceChannels) if coalesceChannels is not None else set()
+		self.maxBatch = maxBatch
+		self.pending = {}
+		self.pendingCount = 0
+		self._lock = threading.Lock()
+		self._flushLock = threading.Lock()
+		self._event = threading.Event()
+		self._thread = None
+
+	def _start(self):
+		if self._thread is not None:
+			return
+		self._thread = threading.Thread(target=self._flushLoop, daemon=True)
+		self._thread.start()
+		atexit.register(self.flush)
+
+	def publish(self, channel, data):
+		"""
+		Add a message to the buffer
+
+		:param channel: channel name
+		:param data: message
+		:return:
+		"""
+		with self._lock:
+			self._start()
+			if channel not in self.pending:
+				# Dictionaries keep insertion order, so they work as ordered sets for coalesced channels
+				self.pending[channel] = {} if channel in self.coalesceChannels else []
+			messages = self.pending[channel]
+			if type(messages) is dict:
+				if data in messages:
+					return
+				messages[data] = None
+			else:
+				messages.append(data)
+			self.pendingCount += 1
+			full = self.pendingCount >= self.maxBatch
+		if full:
+			self.flush()
+		else:
+			self._event.set()
+
+	def flush(self):
+		"""
+		Publish all buffered messages now.
+		When this returns, every message published before the call has been sent to redis.
+
+		:return:
+		"""
+		with self._flushLock:
+			with self._lock:
+				pending = self.pending
+				count = self.pendingCount
+				self.pending = {}
+				self.pendingCount = 0
+			if count == 0:
+				return
+			pipe = (self.redis if self.redis is not None else glob.redis).pipeline(transaction=False)
+			for channel, messages in pending.items():
+				for data in messages:
+					streams.addPublish(pipe, channel, data)
+			pipe.execute()
+			log.debug("Published {} buffered pubsub messages".format(count))
+
+	@sentry.capture()
+	def _timedFlush(self):
+		self.flush()
+
+	def _flushLoop(self):
+		"""
+		Flush the buffer `self.interval` seconds after a message is added to it.
+		Runs forever.
+
+		:return:
+		"""
+		while True:
+			self._event.wait()
+			self._event.clear()
+			time.sleep(self.interval)
+			self._timedFlush()
+
+# Shared publisher. peppy:ban messages just tell bancho to reload a user, so they can be coalesced.
+publisher = batchPublisher(coalesceChannels=("peppy:ban",))
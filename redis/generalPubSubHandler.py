@@ -1,5 +1,23 @@
 import json
 
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+try:
+	import msgspec
+except ImportError:
+	msgspec = None
+
+# Fastest json decoder available. All of them accept bytes directly.
+if orjson is not None:
+	jsonLoads = orjson.loads
+elif msgspec is not None:
+	jsonLoads = msgspec.json.decode
+else:
+	jsonLoads = json.loads
+
 def shape(d):
 	"""
 	Returns a shape of a dictionary.
@@ -13,6 +31,42 @@ def shape(d):
 	else:
 		return None
 
+def compileShape(structure):
+	"""
+	Compile a structure into a function that checks if a dictionary has the same shape.
+	`compileShape(structure)(d)` is the same as `shape(d) == shape(structure)`,
+	but it doesn't build any dictionary.
+
+	:param structure: structure dictionary
+	:return: function that accepts a value and returns True if it has the same shape as `structure`
+	"""
+	if not isinstance(structure, dict):
+		return lambda d: not isinstance(d, dict)
+	keys = frozenset(structure)
+	leaves = tuple(k for k, v in structure.items() if not isinstance(v, dict))
+	children = tuple((k, compileShape(v)) for k, v in structure.items() if isinstance(v, dict))
+
+	def check(d):
+		if not isinstance(d, dict) or d.keys() != keys:
+			return False
+		for k in leaves:
+			if isinstance(d[k], dict):
+				return False
+		for k, f in children:
+			if not f(d[k]):
+				return False
+		return True
+	return check
+
+def isStruct(structure):
+	"""
+	Check if `structure` is a msgspec Struct type
+
+	:param structure: structure
+	:return: True if `structure` is a msgspec Struct type, otherwise False
+	"""
+	return msgspec is not None and isinstance(structure, type) and issubclass(structure, msgspec.Struct)
+
 class wrongStructureError(Exception):
 	pass
 
@@ -21,22 +75,44 @@ class generalPubSubHandler:
 		self.structure = {}
 		self.type = "json"
 		self.strict = True
+		self._compiledStructure = None
+		self._compiledFrom = None
+
+	def _validator(self):
+		"""
+		Return the compiled validator for `self.structure`.
+		It's compiled again only if `self.structure` is replaced.
+
+		:return: validator function
+		"""
+		if self._compiledFrom is not self.structure:
+			self._compiledStructure = compileShape(self.structure)
+			self._compiledFrom = self.structure
+		return self._compiledStructure
 
 	def parseData(self, data):
 		"""
 		Parse received data
 
 		:param data: received data, as bytes array
-		:return: parsed data or None if it's invalid
+		:return: parsed data or None if it's invalid.
+				 If `self.structure` is a msgspec Struct type, the data is returned as an instance of it.
 		"""
 		if self.type == "json":
 			# Parse json
 			if type(data) == int:
 				return None
-			data = json.loads(data.decode("utf-8"))
-			if shape(data) != shape(self.structure) and self.strict:
+			if isStruct(self.structure):
+				try:
+					return msgspec.json.decode(data, type=self.structure)
+				except msgspec.ValidationError:
+					if self.strict:
+						raise wrongStructureError()
+					return jsonLoads(data)
+			data = jsonLoads(data)
+			if self.strict and not self._validator()(data):
 				raise wrongStructureError()
 		elif self.type == "int":
 			# Parse int
 			data = int(data.decode("utf-8"))
-		return data
\ No newline at end of file
+		return data
@@ -1,10 +1,29 @@
+import collections
+import queue
+import random
 import threading
+import time
+
+import redis
+
 from common.log import logUtils as log
 from common.redis import generalPubSubHandler
 from common.sentry import sentry
+from objects import glob
+
+# Overflow policies for concurrent dispatch.
+# BLOCK: wait until there's room in the queue (slows down the whole listener)
+# DROP_OLDEST: discard the oldest queued message of that partition
+# LOG: discard the new message and log it
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_LOG = "log"
 
 class listener(threading.Thread):
-	def __init__(self, r, handlers):
+	def __init__(
+		self, r, handlers, workers=0, queueSize=1000, overflow=OVERFLOW_BLOCK, partitionKey=None,
+		resyncCallbacks=None, minBackoff=0.5, maxBackoff=30
+	):
 		"""
 		Initialize a set of redis pubSub listeners
 
@@ -23,16 +42,192 @@ class listener(threading.Thread):
 
 		- 	A function *object (not call)* that accepts one argument, that'll be the data received through the channel.
 			This is useful if you want to make some simple handlers through a lambda, without having to create a class.
+
+		More channels and patterns can be added later with `subscribe()` and `psubscribe()`.
+		:param workers: number of worker threads that run the handlers. Optional. Default: 0.
+						If 0, handlers are called serially in the listener thread.
+						Otherwise, messages are partitioned between the workers. Messages
+						with the same partition key (the channel name by default) are always handled
+						in order by the same worker, so a slow handler stalls only its own partition.
+		:param queueSize: max number of queued messages per worker. Optional. Default: 1000.
+		:param overflow: what to do when a worker's queue is full. One of
+						 `OVERFLOW_BLOCK`, `OVERFLOW_DROP_OLDEST` or `OVERFLOW_LOG`. Default: `OVERFLOW_BLOCK`.
+		:param partitionKey: function that accepts channel and raw data and returns the partition key.
+							 Optional. Default: the channel name.
+		:param resyncCallbacks: list of functions (without arguments) called after reconnecting to redis.
+								Messages published while disconnected are lost, so caches
+								invalidated through pubsub should flush themselves here. Optional.
+		:param minBackoff: seconds to wait before the first reconnection attempt. Default: 0.5.
+		:param maxBackoff: max seconds to wait between reconnection attempts. Default: 30.
 		"""
 		threading.Thread.__init__(self)
 		self.redis = r
-		self.pubSub = self.redis.pubsub()
-		self.handlers = handlers
-		channels = []
-		for k, v in self.handlers.items():
-			channels.append(k)
-		self.pubSub.subscribe(channels)
-		log.debug("Subscribed to redis pubsub channels: {}".format(channels))
+		self.pubSub = None
+		self.handlers = dict(handlers)
+		self.patternHandlers = {}
+		self._subscriptionsLock = threading.Lock()
+		self._hasSubscriptions = threading.Event()
+		self.resyncCallbacks = resyncCallbacks if resyncCallbacks is not None else []
+		self.minBackoff = minBackoff
+		self.maxBackoff = maxBackoff
+		self.connected = False
+		self.reconnects = 0
+		self._connect()
+
+		# Concurrent dispatch
+		if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_LOG):
+			raise ValueError("Unsupported overflow policy ({})".format(overflow))
+		self.overflow = overflow
+		self.partitionKey = partitionKey
+		self.queues = [queue.Queue(maxsize=queueSize) for _ in range(workers)]
+		self.queueDepth = collections.Counter()
+		self._queueDepthLock = threading.Lock()
+		self.workers = [
+			threading.Thread(target=self._workerLoop, args=(q,), daemon=True) for q in self.queues
+		]
+
+	def _connect(self):
+		"""
+		Open a new pubsub connection and subscribe to every channel in
+		`self.handlers` and every pattern in `self.patternHandlers`
+
+		:return:
+		"""
+		with self._subscriptionsLock:
+			self.pubSub = self.redis.pubsub()
+			channels = list(self.handlers.keys())
+			patterns = list(self.patternHandlers.keys())
+			if channels:
+				self.pubSub.subscribe(channels)
+			if patterns:
+				self.pubSub.psubscribe(patterns)
+			self._updateHasSubscriptions()
+			self._setConnected(True)
+		log.debug("Subscribed to redis pubsub channels: {}, patterns: {}".format(channels, patterns))
+
+	def _pubSubCall(self, command, *args):
+		"""
+		Run a (un)subscribe command on the current connection. Must be called with `_subscriptionsLock` held.
+		Does nothing while disconnected, `_connect()` resubscribes from `handlers` and `patternHandlers` anyway.
+		Connection errors are logged only: the listener thread notices them as well, and reconnects.
+
+		:param command: pubsub method name (eg: "subscribe")
+		:param args: command arguments
+		:return:
+		"""
+		if not self.connected:
+			return
+		try:
+			getattr(self.pubSub, command)(*args)
+		except (redis.ConnectionError, redis.TimeoutError, OSError) as e:
+			log.warning("Redis pubsub: {} {} failed, it will be done after reconnecting ({})".format(command, args, e))
+
+	def _updateHasSubscriptions(self):
+		if self.handlers or self.patternHandlers:
+			self._hasSubscriptions.set()
+		else:
+			self._hasSubscriptions.clear()
+
+	def subscribe(self, channel, handler):
+		"""
+		Subscribe to a channel. Can be called from any thread, even while the listener is running or reconnecting.
+		If the channel already has a handler, it's replaced.
+
+		:param channel: channel name
+		:param handler: handler, same as the values of `handlers` in `__init__`
+		:return:
+		"""
+		with self._subscriptionsLock:
+			# Copy on write, so the listener thread never sees a dictionary that's changing
+			self.handlers = {**self.handlers, channel: handler}
+			self._pubSubCall("subscribe", channel)
+			self._updateHasSubscriptions()
+		log.debug("Subscribed to redis pubsub channel: {}".format(channel))
+
+	def unsubscribe(self, channel):
+		"""
+		Unsubscribe from a channel. Can be called from any thread, even while the listener is running or reconnecting.
+
+		:param channel: channel name
+		:return:
+		"""
+		with self._subscriptionsLock:
+			if channel not in self.handlers:
+				return
+			self.handlers = {k: v for k, v in self.handlers.items() if k != channel}
+			self._pubSubCall("unsubscribe", channel)
+			self._updateHasSubscriptions()
+		log.debug("Unsubscribed from redis pubsub channel: {}".format(channel))
+
+	def psubscribe(self, pattern, handler):
+		"""
+		Subscribe to all channels matching a pattern (eg: `peppy:*`).
+		Can be called from any thread, even while the listener is running or reconnecting.
+		Pattern handlers receive the matched channel name as well, so they are called as
+		`handler(channel, data)` (functions) or `handler.handle(channel, data)` (generalPubSubHandler objects).
+
+		:param pattern: glob-style pattern
+		:param handler: pattern handler
+		:return:
+		"""
+		with self._subscriptionsLock:
+			self.patternHandlers = {**self.patternHandlers, pattern: handler}
+			self._pubSubCall("psubscribe", pattern)
+			self._updateHasSubscriptions()
+		log.debug("Subscribed to redis pubsub pattern: {}".format(pattern))
+
+	def punsubscribe(self, pattern):
+		"""
+		Unsubscribe from a pattern. Can be called from any thread, even while the listener is running or reconnecting.
+
+		:param pattern: glob-style pattern
+		:return:
+		"""
+		with self._subscriptionsLock:
+			if pattern not in self.patternHandlers:
+				return
+			self.patternHandlers = {k: v for k, v in self.patternHandlers.items() if k != pattern}
+			self._pubSubCall("punsubscribe", pattern)
+			self._updateHasSubscriptions()
+		log.debug("Unsubscribed from redis pubsub pattern: {}".format(pattern))
+
+	def _setConnected(self, connected):
+		self.connected = connected
+		glob.dog.gauge(glob.DATADOG_PREFIX + ".pubsub.connected", int(connected))
+
+	def reconnect(self):
+		"""
+		Reconnect to redis with exponential backoff, resubscribe to all channels and call the resync callbacks.
+		Blocks until the connection is restored.
+
+		:return:
+		"""
+		with self._subscriptionsLock:
+			# Under the lock, so (un)subscribe calls never use the closed connection
+			self._setConnected(False)
+			try:
+				self.pubSub.close()
+			except Exception:
+				pass
+		attempt = 0
+		while True:
+			backoff = min(self.maxBackoff, self.minBackoff * (2 ** attempt))
+			time.sleep(backoff * random.uniform(0.5, 1))
+			attempt += 1
+			try:
+				self._connect()
+				break
+			except (redis.ConnectionError, redis.TimeoutError, OSError) as e:
+				log.warning("Redis pubsub: reconnection attempt {} failed ({})".format(attempt, e))
+		self.reconnects += 1
+		glob.dog.increment(glob.DATADOG_PREFIX + ".pubsub.reconnects")
+		log.info("Redis pubsub: reconnected after {} attempts".format(attempt))
+		for callback in self.resyncCallbacks:
+			self._resync(callback)
+
+	@sentry.capture()
+	def _resync(self, callback):
+		callback()
 
 	@sentry.capture()
 	def processItem(self, item):
@@ -42,20 +237,118 @@ class listener(threading.Thread):
 		:param item: incoming data
 		:return:
 		"""
-		if item["type"] == "message":
+		if item["type"] == "message" or item["type"] == "pmessage":
 			# Process the message only if the channel has received a message
 			# Decode the message
 			item["channel"] = item["channel"].decode("utf-8")
+			pattern = None
+			if item["type"] == "pmessage":
+				pattern = item["pattern"].decode("utf-8")
+				handlers = self.patternHandlers
+			else:
+				handlers = self.handlers
 
 			# Make sure the handler exists
-			if item["channel"] in self.handlers:
+			if (item["channel"] if pattern is None else pattern) in handlers:
 				log.info("Redis pubsub: {} <- {} ".format(item["channel"], item["data"]))
-				if isinstance(self.handlers[item["channel"]], generalPubSubHandler.generalPubSubHandler):
-					# Handler class
-					self.handlers[item["channel"]].handle(item["data"])
+				if self.queues:
+					self.enqueue(item["channel"], item["data"], pattern)
 				else:
-					# Function
-					self.handlers[item["channel"]](item["data"])
+					self.handle(item["channel"], item["data"], pattern)
+
+	def handle(self, channel, data, pattern=None):
+		"""
+		Call `channel`'s handler (or `pattern`'s handler) with `data`
+
+		:param channel: channel name
+		:param data: raw data
+		:param pattern: matched pattern, if the message was received through a pattern subscription. Optional.
+		:return:
+		"""
+		if pattern is None:
+			handler = self.handlers.get(channel)
+			args = (data,)
+		else:
+			handler = self.patternHandlers.get(pattern)
+			args = (channel, data)
+		if handler is None:
+			# Unsubscribed while the message was queued
+			return
+		start = time.perf_counter()
+		try:
+			if isinstance(handler, generalPubSubHandler.generalPubSubHandler):
+				# Handler class
+				handler.handle(*args)
+			else:
+				# Function
+				handler(*args)
+		finally:
+			glob.dog.histogram(
+				glob.DATADOG_PREFIX + ".pubsub.handler_latency",
+				time.perf_counter() - start,
+				tags=["channel:{}".format(channel)]
+			)
+
+	def _updateQueueDepth(self, channel, delta):
+		with self._queueDepthLock:
+			self.queueDepth[channel] += delta
+			depth = self.queueDepth[channel]
+		glob.dog.gauge(glob.DATADOG_PREFIX + ".pubsub.queue_depth", depth, tags=["channel:{}".format(channel)])
+
+	def enqueue(self, channel, data, pattern=None):
+		"""
+		Add a message to its worker's queue, applying the overflow policy if the queue is full
+
+		:param channel: channel name
+		:param data: raw data
+		:param pattern: matched pattern. Optional.
+		:return:
+		"""
+		key = channel if self.partitionKey is None else self.partitionKey(channel, data)
+		q = self.queues[hash(key) % len(self.queues)]
+		self._updateQueueDepth(channel, 1)
+		if self.overflow == OVERFLOW_BLOCK:
+			q.put((channel, data, pattern))
+		else:
+			while True:
+				try:
+					q.put_nowait((channel, data, pattern))
+					break
+				except queue.Full:
+					if self.overflow == OVERFLOW_LOG:
+						self._updateQueueDepth(channel, -1)
+						log.warning("Redis pubsub: queue full, dropping {} <- {}".format(channel, data))
+						glob.dog.increment(glob.DATADOG_PREFIX + ".pubsub.dropped", tags=["channel:{}".format(channel)])
+						return
+					# Drop oldest
+					try:
+						oldChannel, oldData, _ = q.get_nowait()
+					except queue.Empty:
+						continue
+					q.task_done()
+					self._updateQueueDepth(oldChannel, -1)
+					log.warning("Redis pubsub: queue full, dropping {} <- {}".format(oldChannel, oldData))
+					glob.dog.increment(glob.DATADOG_PREFIX + ".pubsub.dropped", tags=["channel:{}".format(oldChannel)])
+
+	@sentry.capture()
+	def _handleQueued(self, channel, data, pattern):
+		self.handle(channel, data, pattern)
+
+	def _workerLoop(self, q):
+		"""
+		Handle messages from a worker queue, in order.
+		Runs forever.
+
+		:param q: worker queue
+		:return:
+		"""
+		while True:
+			channel, data, pattern = q.get()
+			self._updateQueueDepth(channel, -1)
+			try:
+				self._handleQueued(channel, data, pattern)
+			finally:
+				q.task_done()
 
 	def run(self):
 		"""
@@ -64,5 +357,17 @@ class listener(threading.Thread):
 
 		:return:
 		"""
-		for item in self.pubSub.listen():
-			self.processItem(item)
\ No newline at end of file
+		for w in self.workers:
+			w.start()
+		while True:
+			try:
+				for item in self.pubSub.listen():
+					self.processItem(item)
+
+				# listen() returns when there are no subscriptions, wait for a new one.
+				# Sleep briefly anyway, in case redis-py's state lags behind ours.
+				self._hasSubscriptions.wait()
+				time.sleep(0.05)
+			except (redis.ConnectionError, redis.TimeoutError, OSError) as e:
+				log.error("Redis pubsub: connection lost ({}). Reconnecting.".format(e))
+				self.reconnect()
@@ -0,0 +1,114 @@
+import threading
+from concurrent.futures import Future
+
+from objects import glob
+
+_local = threading.local()
+
+class redisBatch:
+	"""
+	A list of redis commands that will be sent with a single pipeline.
+	Don't create it directly, use `batch()`.
+	"""
+	def __init__(self, r):
+		"""
+		Initialize an empty batch
+
+		:param r: redis instance
+		"""
+		self.redis = r
+		self.commands = []
+
+	def add(self, command, *args, **kwargs):
+		"""
+		Add a command to the batch
+
+		:param command: redis-py method name (eg: `zrem`)
+		:param args: command args
+		:param kwargs: command kwargs
+		:return: Future that will contain the result of the command
+		"""
+		f = Future()
+		self.commands.append((command, args, kwargs, f))
+		return f
+
+	def execute(self):
+		"""
+		Send all commands in the batch with a single pipeline and set their futures' results.
+		Errors of single commands are set on their future.
+
+		:return:
+		"""
+		commands, self.commands = self.commands, []
+		if not commands:
+			return
+		pipe = self.redis.pipeline(transaction=False)
+		for command, args, kwargs, _ in commands:
+			getattr(pipe, command)(*args, **kwargs)
+		try:
+			results = pipe.execute(raise_on_error=False)
+		except Exception as e:
+			for *_, f in commands:
+				f.set_exception(e)
+			raise
+		for (*_, f), result in zip(commands, results):
+			if isinstance(result, Exception):
+				f.set_exception(result)
+			else:
+				f.set_result(result)
+
+class batch:
+	"""
+	Context manager that collects the redis commands issued through `call()`
+	in this thread (even by nested helper functions) and sends them
+	with a single pipeline when it exits:
+	```
+	with redisBatch.batch():
+		a = redisBatch.call("get", "a")
+		removeFromLeaderboard(userID)
+	print(a.result())
+	```
+	Nested batches join the outermost one.
+	Commands are sent even if an exception is raised inside the block,
+	so the redis state is the same as if they were sent one by one.
+	"""
+	def __init__(self, r=None):
+		"""
+		:param r: redis instance. Optional. Default: glob.redis.
+		"""
+		self.redis = r
+		self.batch = None
+		self.outermost = False
+
+	def __enter__(self):
+		current = getattr(_local, "batch", None)
+		if current is None:
+			current = redisBatch(self.redis if self.redis is not None else glob.redis)
+			_local.batch = current
+			self.outermost = True
+		self.batch = current
+		return current
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		if not self.outermost:
+			return
+		_local.batch = None
+		self.batch.execute()
+
+def call(command, *args, **kwargs):
+	"""
+	Run a redis command, or add it to the current batch if there is one.
+	Don't use the result of commands that are part of a batch before it exits.
+	Outside of a batch, the command is sent immediately and errors are raised as usual.
+
+	:param command: redis-py method name (eg: `zrem`)
+	:param args: command args
+	:param kwargs: command kwargs
+	:return: Future that contains (or will contain) the result of the command
+	"""
+	current = getattr(_local, "batch", None)
+	if current is not None:
+		return current.add(command, *args, **kwargs)
+	f = Future()
+	f.set_result(getattr(glob.redis, command)(*args, **kwargs))
+	return f
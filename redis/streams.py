@@ -0,0 +1,233 @@
+import os
+import socket
+import threading
+import time
+
+import redis
+
+from common.log import logUtils as log
+from common.redis import generalPubSubHandler
+from common.sentry import sentry
+from objects import glob
+
+# Channels that are published to redis streams as well as pubsub.
+# Services that want durable delivery for a channel call `enable()` on it.
+enabledChannels = set()
+
+def streamKey(channel):
+	"""
+	Return the redis key of the stream used for `channel`
+
+	:param channel: channel name
+	:return: stream key
+	"""
+	return "ripple:streams:{}".format(channel)
+
+def deadLetterKey(channel):
+	"""
+	Return the redis key of the stream where `channel`'s messages that could not be handled end up
+
+	:param channel: channel name
+	:return: stream key
+	"""
+	return "{}:dead".format(streamKey(channel))
+
+def enable(*channels):
+	"""
+	Publish `channels` to redis streams as well, through `publish()`
+
+	:param channels: channel names
+	:return:
+	"""
+	enabledChannels.update(channels)
+
+def publish(channel, data, maxLen=10000, r=None):
+	"""
+	Publish a message on a pubsub channel and, if the channel is enabled, on its stream.
+	Drop-in replacement for `glob.redis.publish`.
+
+	:param channel: channel name
+	:param data: message
+	:param maxLen: approximate max number of messages kept in the stream. Default: 10000.
+	:param r: redis instance. Optional. Default: glob.redis.
+	:return:
+	"""
+	if r is None:
+		r = glob.redis
+	if channel not in enabledChannels:
+		r.publish(channel, data)
+		return
+	pipe = r.pipeline(transaction=False)
+	addPublish(pipe, channel, data, maxLen)
+	pipe.execute()
+
+def addPublish(pipe, channel, data, maxLen=10000):
+	"""
+	Same as `publish()`, but queues the commands in a redis pipeline
+
+	:param pipe: redis pipeline
+	:param channel: channel name
+	:param data: message
+	:param maxLen: approximate max number of messages kept in the stream. Default: 10000.
+	:return:
+	"""
+	pipe.publish(channel, data)
+	if channel in enabledChannels:
+		pipe.xadd(streamKey(channel), {"data": data}, maxlen=maxLen, approximate=True)
+
+class streamListener(threading.Thread):
+	def __init__(
+		self, r, handlers, group, consumer=None, batchSize=100, block=5000,
+		claimIdle=60000, claimInterval=30, maxDeliveries=5, deadLetter=True
+	):
+		"""
+		Initialize a set of redis streams consumers.
+		Same interface as `common.redis.pubSub.listener`, but messages are read through
+		a consumer group, so they're not lost if the consumer is not running when they're published.
+		Messages are acknowledged after their handler returns. If a handler raises an exception or the
+		consumer crashes, the message stays pending and it's reclaimed after `claimIdle` ms.
+		A message whose handler has failed `maxDeliveries` times is logged, acknowledged and
+		moved to the channel's dead letter stream (`deadLetterKey(channel)`).
+
+		:param r: redis instance (usually glob.redis). Requires redis >= 6.2.
+		:param handlers: same as `common.redis.pubSub.listener`
+		:param group: consumer group name. Every group receives all messages,
+					  consumers in the same group share them.
+		:param consumer: consumer name, must be unique and stable in the group. Default: hostname:pid.
+		:param batchSize: max number of messages read at once. Default: 100.
+		:param block: max ms to wait for new messages on each read. Default: 5000.
+		:param claimIdle: ms after which a pending message of another consumer is reclaimed. Default: 60000.
+		:param claimInterval: seconds between pending messages reclaims. Default: 30.
+		:param maxDeliveries: max number of times a message is handled before giving up on it. Default: 5.
+		:param deadLetter: if True, copy the messages we've given up on to the dead letter stream. Default: True.
+		"""
+		threading.Thread.__init__(self)
+		self.redis = r
+		self.handlers = handlers
+		self.group = group
+		self.consumer = consumer if consumer is not None else "{}:{}".format(socket.gethostname(), os.getpid())
+		self.batchSize = batchSize
+		self.block = block
+		self.claimIdle = claimIdle
+		self.claimInterval = claimInterval
+		self.maxDeliveries = maxDeliveries
+		self.deadLetter = deadLetter
+		self.streams = {streamKey(k): k for k in self.handlers}
+		for k in self.streams:
+			try:
+				self.redis.xgroup_create(k, self.group, id="$", mkstream=True)
+			except redis.ResponseError as e:
+				# The group exists already
+				if "BUSYGROUP" not in str(e):
+					raise
+		log.debug("Subscribed to redis streams: {} (group {})".format(list(self.handlers), self.group))
+
+	@sentry.capture()
+	def _handle(self, channel, data):
+		"""
+		Call `channel`'s handler with `data`
+
+		:param channel: channel name
+		:param data: raw data
+		:return: True if the handler returned, False if it raised an exception
+		"""
+		log.info("Redis stream: {} <- {} ".format(channel, data))
+		if isinstance(self.handlers[channel], generalPubSubHandler.generalPubSubHandler):
+			# Handler class
+			self.handlers[channel].handle(data)
+		else:
+			# Function
+			self.handlers[channel](data)
+		return True
+
+	def _giveUp(self, key, channel, entryID, data):
+		"""
+		Check how many times a message whose handler failed has been delivered
+
+		:param key: stream key
+		:param channel: channel name
+		:param entryID: message id
+		:param data: raw data
+		:return: True if it's been delivered `self.maxDeliveries` times (it's been dead-lettered),
+				 False if it must stay pending to be retried
+		"""
+		pending = self.redis.xpending_range(key, self.group, min=entryID, max=entryID, count=1)
+		if pending and pending[0]["times_delivered"] < self.maxDeliveries:
+			return False
+		log.error("Redis stream: giving up on message {} from {} after {} deliveries ({})".format(
+			entryID, channel, self.maxDeliveries, data
+		))
+		if self.deadLetter:
+			self.redis.xadd(deadLetterKey(channel), {"data": data, "id": entryID, "group": self.group})
+		glob.dog.increment(glob.DATADOG_PREFIX + ".streams.dead_letters", tags=["channel:{}".format(channel)])
+		return True
+
+	def processEntries(self, key, entries):
+		"""
+		Handle stream entries and acknowledge the ones that have been handled successfully,
+		or that have failed too many times
+
+		:param key: stream key
+		:param entries: list of (id, fields) tuples
+		:return:
+		"""
+		if type(key) is bytes:
+			key = key.decode("utf-8")
+		channel = self.streams[key]
+		handled = []
+		for entryID, fields in entries:
+			# Deleted entries (trimmed while pending) have no fields
+			if not fields:
+				handled.append(entryID)
+				continue
+			if self._handle(channel, fields[b"data"]) or self._giveUp(key, channel, entryID, fields[b"data"]):
+				handled.append(entryID)
+		if handled:
+			self.redis.xack(key, self.group, *handled)
+
+	def reclaim(self):
+		"""
+		Handle pending messages that have not been acknowledged for more than `self.claimIdle` ms,
+		eg: because their consumer crashed.
+
+		:return:
+		"""
+		for key in self.streams:
+			start = "0-0"
+			while True:
+				result = self.redis.xautoclaim(key, self.group, self.consumer, self.claimIdle, start, count=self.batchSize)
+				start, entries = result[0], result[1]
+				if entries:
+					log.info("Redis stream: reclaimed {} messages from {}".format(len(entries), key))
+					self.processEntries(key, entries)
+				if start in (b"0-0", "0-0"):
+					break
+
+	def run(self):
+		"""
+		Read and handle new messages.
+		Runs forever.
+
+		:return:
+		"""
+		ownPendingHandled = False
+		lastClaim = 0
+		while True:
+			try:
+				if not ownPendingHandled:
+					# Handle our own pending messages first (left there if we crashed)
+					for key, entries in self.redis.xreadgroup(self.group, self.consumer, {k: "0" for k in self.streams}):
+						self.processEntries(key, entries)
+					ownPendingHandled = True
+				if time.monotonic() - lastClaim >= self.claimInterval:
+					self.reclaim()
+					lastClaim = time.monotonic()
+				result = self.redis.xreadgroup(
+					self.group, self.consumer, {k: ">" for k in self.streams},
+					count=self.batchSize, block=self.block
+				)
+				for key, entries in result or []:
+					self.processEntries(key, entries)
+			except (redis.ConnectionError, redis.TimeoutError, OSError) as e:
+				log.error("Redis stream: connection error ({}). Retrying.".format(e))
+				time.sleep(1)
@@ -1,7 +1,19 @@
 import json
 
-from objects import glob
+from common.redis import batchPublisher, streams
 
 
-def notification(userID, message):
-	glob.redis.publish("peppy:notification", json.dumps({"userID": userID, "message": message}))
+def notification(userID, message, batch=False):
+	"""
+	Send a notification to `userID` through bancho
+
+	:param userID: user id
+	:param message: notification text
+	:param batch: if True, publish it through the shared batch publisher. Use it for mass notifications.
+	:return:
+	"""
+	data = json.dumps({"userID": userID, "message": message})
+	if batch:
+		batchPublisher.publisher.publish("peppy:notification", data)
+	else:
+		streams.publish("peppy:notification", data)
@@ -0,0 +1,141 @@
+import numpy
+
+from common.constants import mods
+
+# Same values, in the same order, as the ones returned by generalUtils.getRank
+GRADES = numpy.array(["XH", "X", "SH", "S", "A", "B", "C", "D"])
+_XH, _X, _SH, _S, _A, _B, _C, _D = range(len(GRADES))
+
+# Max number of scores used by userUtils.calculateAccuracy and userUtils.calculatePP
+MAX_SCORES = 500
+
+# Weights used by userUtils.calculateAccuracy and userUtils.calculatePP.
+# Computed with python floats so the results are exactly the same as the scalar functions.
+ACCURACY_WEIGHTS = numpy.array([int((0.95 ** k) * 100) for k in range(MAX_SCORES)], dtype=numpy.int64)
+PP_WEIGHTS = numpy.array([0.95 ** k for k in range(MAX_SCORES)], dtype=numpy.float64)
+
+
+def getRankCodes(gameModes, __mods, acc, c300, c100, c50, cmiss):
+	"""
+	Vectorized version of generalUtils.getRank that returns grade codes (indexes in `GRADES`).
+	All arguments are array-likes with the same shape (or scalars).
+	Scores with no hits are graded D in osu!std, instead of raising ZeroDivisionError.
+
+	:param gameModes: game mode numbers
+	:param __mods: mods values
+	:param acc: accuracies
+	:param c300: 300 hit counts
+	:param c100: 100 hit counts
+	:param c50: 50 hit counts
+	:param cmiss: misses counts
+	:return: int8 array with grade codes
+	"""
+	gameModes, __mods, acc, c300, c100, c50, cmiss = numpy.broadcast_arrays(
+		*(numpy.asarray(x) for x in (gameModes, __mods, acc, c300, c100, c50, cmiss))
+	)
+	acc = acc.astype(numpy.float64, copy=False)
+	hdfl = (__mods & (mods.HIDDEN | mods.FLASHLIGHT)) > 0
+	ss = numpy.where(hdfl, _XH, _X)
+	s = numpy.where(hdfl, _SH, _S)
+
+	# osu!std
+	total = (c300 + c100 + c50 + cmiss).astype(numpy.float64)
+	with numpy.errstate(divide="ignore", invalid="ignore"):
+		r300 = c300 / total
+		r50 = c50 / total
+	noMiss = cmiss == 0
+	std = numpy.select(
+		[
+			acc == 100,
+			(r300 > 0.90) & (r50 < 0.1) & noMiss,
+			((r300 > 0.80) & noMiss) | (r300 > 0.90),
+			((r300 > 0.70) & noMiss) | (r300 > 0.80),
+			r300 > 0.60
+		],
+		[ss, s, _A, _B, _C],
+		_D
+	)
+
+	# CtB. The C range is empty in getRank as well.
+	ctb = numpy.select(
+		[
+			acc == 100,
+			(98.01 <= acc) & (acc <= 99.99),
+			(94.01 <= acc) & (acc <= 98.00),
+			(90.01 <= acc) & (acc <= 94.00)
+		],
+		[ss, s, _A, _B],
+		_D
+	)
+
+	# osu!mania
+	mania = numpy.select(
+		[acc == 100, acc > 95, acc > 90, acc > 80, acc > 70],
+		[ss, s, _A, _B, _C],
+		_D
+	)
+
+	# Taiko and unknown game modes are always A
+	return numpy.select(
+		[gameModes == 0, gameModes == 2, gameModes == 3],
+		[std, ctb, mania],
+		_A
+	).astype(numpy.int8)
+
+
+def getRanks(gameModes, __mods, acc, c300, c100, c50, cmiss):
+	"""
+	Vectorized version of generalUtils.getRank.
+	Same as getRankCodes, but returns the grade strings.
+
+	:return: array of rank/grade strings
+	"""
+	return GRADES[getRankCodes(gameModes, __mods, acc, c300, c100, c50, cmiss)]
+
+
+def _prepareTopScores(values):
+	"""
+	Convert per-user top scores to a (scores, users) float64 array and its validity mask.
+	Transposing the array makes numpy sum scores in order, like the scalar functions do.
+
+	:param values: 2-D array-like with shape (users, scores). Shorter rows must be padded with NaN.
+	:return: (values, mask) tuple, both with shape (scores, users)
+	"""
+	values = numpy.atleast_2d(numpy.asarray(values, dtype=numpy.float64))[:, :MAX_SCORES]
+	values = numpy.ascontiguousarray(values.T)
+	mask = ~numpy.isnan(values)
+	return values, mask
+
+
+def weightedAccuracies(accuracies):
+	"""
+	Vectorized version of userUtils.calculateAccuracy.
+	Returns exactly the same values.
+
+	:param accuracies: 2-D array-like with shape (users, scores).
+					   Each row contains a user's scores accuracies, sorted by pp (desc).
+					   Shorter rows must be padded with NaN.
+	:return: float64 array with one weighted accuracy per user
+	"""
+	accuracies, mask = _prepareTopScores(accuracies)
+	weights = numpy.where(mask, ACCURACY_WEIGHTS[:len(accuracies), None], 0)
+	# Sum along axis 0 of a C-contiguous array is a sequential sum, not a pairwise one
+	totalAcc = numpy.where(mask, accuracies * weights, 0).sum(axis=0)
+	divideTotal = weights.sum(axis=0)
+	with numpy.errstate(divide="ignore", invalid="ignore"):
+		return numpy.where(divideTotal != 0, totalAcc / divideTotal, 0.0)
+
+
+def totalPPs(pps):
+	"""
+	Vectorized version of userUtils.calculatePP.
+	Returns exactly the same values.
+
+	:param pps: 2-D array-like with shape (users, scores).
+				Each row contains a user's scores pp, sorted desc.
+				Shorter rows must be padded with NaN.
+	:return: int64 array with one total pp value per user
+	"""
+	pps, mask = _prepareTopScores(pps)
+	weighted = numpy.round(numpy.round(numpy.where(mask, pps, 0)) * PP_WEIGHTS[:len(pps), None])
+	return weighted.astype(numpy.int64).sum(axis=0)
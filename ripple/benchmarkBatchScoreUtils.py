@@ -0,0 +1,90 @@
+"""
+Benchmark of ripple.batchScoreUtils against the scalar functions it replaces
+(generalUtils.getRank, userUtils.calculateAccuracy and userUtils.calculatePP).
+Also checks that both versions return exactly the same values (exits with 1 if they don't).
+
+Run it from a directory where `common` and `objects` are importable:
+	python -m common.ripple.benchmarkBatchScoreUtils [--scores 200000] [--users 2000]
+"""
+import argparse
+import sys
+import time
+
+import numpy
+
+from common import generalUtils
+from common.ripple import batchScoreUtils, userUtils
+from objects import glob
+
+class _fakeDb:
+	"""
+	Returns pre-generated rows, so the scalar functions can run without a database.
+	"""
+	def __init__(self, rows):
+		self.rows = rows
+
+	def fetchAll(self, query, params=None):
+		return self.rows[params[0]]
+
+def _timed(f):
+	start = time.perf_counter()
+	result = f()
+	return result, time.perf_counter() - start
+
+def _report(name, scalarTime, vectorTime, mismatches):
+	print("{:<20} scalar {:8.3f}s  vectorized {:8.3f}s  x{:<6.1f} mismatches: {}".format(
+		name, scalarTime, vectorTime, scalarTime / vectorTime, mismatches
+	))
+	return mismatches
+
+def benchmarkRanks(n, rng):
+	gameModes = rng.randint(0, 4, n)
+	__mods = rng.choice([0, 8, 1024, 64], n)
+	acc = numpy.round(rng.uniform(60, 100, n), 2)
+	acc[rng.rand(n) < 0.05] = 100
+	c300 = rng.randint(1, 2000, n)
+	c100 = rng.randint(0, 200, n)
+	c50 = rng.randint(0, 50, n)
+	cmiss = rng.randint(0, 3, n) * rng.randint(0, 2, n)
+	columns = [x.tolist() for x in (gameModes, __mods, acc, c300, c100, c50, cmiss)]
+
+	scalar, scalarTime = _timed(lambda: [generalUtils.getRank(*x) for x in zip(*columns)])
+	vector, vectorTime = _timed(lambda: batchScoreUtils.getRanks(gameModes, __mods, acc, c300, c100, c50, cmiss))
+	return _report("getRanks", scalarTime, vectorTime, sum(a != b for a, b in zip(scalar, vector.tolist())))
+
+def _topScores(users, rng, low, high):
+	lengths = rng.randint(0, batchScoreUtils.MAX_SCORES + 1, users)
+	values = numpy.full((users, batchScoreUtils.MAX_SCORES), numpy.nan)
+	for i, length in enumerate(lengths):
+		values[i, :length] = numpy.sort(rng.uniform(low, high, length))[::-1]
+	return values, lengths
+
+def benchmarkAccuracies(users, rng):
+	values, lengths = _topScores(users, rng, 50, 100)
+	glob.db = _fakeDb([[{"accuracy": x} for x in row[:length].tolist()] for row, length in zip(values, lengths)])
+	scalar, scalarTime = _timed(lambda: [userUtils.calculateAccuracy(i, 0) for i in range(users)])
+	vector, vectorTime = _timed(lambda: batchScoreUtils.weightedAccuracies(values))
+	return _report("weightedAccuracies", scalarTime, vectorTime, sum(a != b for a, b in zip(scalar, vector.tolist())))
+
+def benchmarkPPs(users, rng):
+	values, lengths = _topScores(users, rng, 0, 1000)
+	glob.db = _fakeDb([[{"pp": x} for x in row[:length].tolist()] for row, length in zip(values, lengths)])
+	scalar, scalarTime = _timed(lambda: [userUtils.calculatePP(i, 0) for i in range(users)])
+	vector, vectorTime = _timed(lambda: batchScoreUtils.totalPPs(values))
+	return _report("totalPPs", scalarTime, vectorTime, sum(a != b for a, b in zip(scalar, vector.tolist())))
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark ripple.batchScoreUtils")
+	parser.add_argument("--scores", type=int, default=200000, help="number of scores graded by getRanks")
+	parser.add_argument("--users", type=int, default=2000, help="number of users for accuracy/pp")
+	parser.add_argument("--seed", type=int, default=0, help="random seed")
+	args = parser.parse_args()
+	rng = numpy.random.RandomState(args.seed)
+	mismatches = benchmarkRanks(args.scores, rng)
+	mismatches += benchmarkAccuracies(args.users, rng)
+	mismatches += benchmarkPPs(args.users, rng)
+	# Non-zero exit code if the vectorized functions aren't exact
+	return 1 if mismatches else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
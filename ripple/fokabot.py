@@ -1,10 +1,9 @@
-import requests
-
+from common.web import httpClient
 from objects import glob
 
 
 def _request(handler, json, timeout=3):
-	return requests.post(
+	return httpClient.post(
 		"{}/{}".format(glob.conf["FOKABOT_API_BASE"].rstrip("/"), handler.lstrip("/")),
 		headers={"Secret": glob.conf["FOKABOT_API_SECRET"]},
 		json=json,
@@ -0,0 +1,190 @@
+import threading
+import time
+
+from common.log import logUtils as log
+from common.redis import generalPubSubHandler
+from objects import glob
+
+INVALIDATE_CHANNEL = "peppy:sessions_invalidate"
+
+class sessionsCache:
+	"""
+	In-process cache of bancho sessions (`peppy:sessions:<userID>` redis sets).
+	Used by `userUtils.checkBanchoSession` to avoid a redis round trip on every LETS request.
+	Entries are invalidated through the `peppy:sessions_invalidate` pubsub channel
+	(see `invalidationHandler`) and expire after `ttl` seconds anyway, for safety.
+	"""
+	def __init__(self, ttl=30):
+		"""
+		Initialize a disabled sessions cache. Call `enable()` to turn it on.
+
+		:param ttl: seconds after which a cached session set is fetched again from redis. Default: 30.
+		"""
+		self.ttl = ttl
+		self.enabled = False
+		self.sessions = {}
+		# Bumped every time a user's sessions change, so fetches that raced with a change aren't cached.
+		# `_generation` is bumped when the whole cache is invalidated.
+		self.generations = {}
+		self._generation = 0
+		self._lock = threading.Lock()
+
+	def enable(self, ttl=None):
+		"""
+		Enable the cache.
+		Remember to subscribe `invalidationHandler` to `INVALIDATE_CHANNEL`,
+		otherwise entries will be updated only after they expire.
+
+		:param ttl: new ttl, in seconds. Optional.
+		:return:
+		"""
+		if ttl is not None:
+			self.ttl = ttl
+		self.enabled = True
+
+	def _currentGeneration(self, userID):
+		return self._generation, self.generations.get(userID, 0)
+
+	def _bump(self, userID):
+		# Must be called with `_lock` held
+		self.generations[userID] = self.generations.get(userID, 0) + 1
+
+	def _fetch(self, userID):
+		"""
+		Get `userID`'s session IPs from redis and cache them,
+		unless they've changed while they were being fetched
+
+		:param userID: user id
+		:return: frozenset of IPs
+		"""
+		with self._lock:
+			generation = self._currentGeneration(userID)
+		ips = frozenset(x.decode("utf-8") for x in glob.redis.smembers("peppy:sessions:{}".format(userID)))
+		with self._lock:
+			if self._currentGeneration(userID) == generation:
+				self.sessions[userID] = (ips, time.time() + self.ttl)
+		return ips
+
+	def get(self, userID):
+		"""
+		Return `userID`'s session IPs, from cache if possible, otherwise from redis
+
+		:param userID: user id
+		:return: frozenset of IPs
+		"""
+		userID = int(userID)
+		entry = self.sessions.get(userID)
+		if entry is not None and entry[1] > time.time():
+			return entry[0]
+		return self._fetch(userID)
+
+	def contains(self, userID, ip=""):
+		"""
+		Return True if there is a cached bancho session for `userID` from `ip`.
+		If `ip` is an empty string, check if there's a bancho session for that user, from any IP.
+
+		:param userID: user id
+		:param ip: ip address. Optional. Default: empty string
+		:return: True if there's an active bancho session, else False
+		"""
+		ips = self.get(userID)
+		if ip != "":
+			return ip in ips
+		return len(ips) > 0
+
+	def add(self, userID, ip):
+		"""
+		Add a session to the local cache, if `userID` is already cached
+
+		:param userID: user id
+		:param ip: ip address
+		:return:
+		"""
+		userID = int(userID)
+		with self._lock:
+			self._bump(userID)
+			entry = self.sessions.get(userID)
+			if entry is not None:
+				self.sessions[userID] = (entry[0] | {ip}, entry[1])
+
+	def remove(self, userID, ip):
+		"""
+		Remove a session from the local cache, if `userID` is already cached
+
+		:param userID: user id
+		:param ip: ip address
+		:return:
+		"""
+		userID = int(userID)
+		with self._lock:
+			self._bump(userID)
+			entry = self.sessions.get(userID)
+			if entry is not None:
+				self.sessions[userID] = (entry[0] - {ip}, entry[1])
+
+	def invalidate(self, userID=None):
+		"""
+		Drop `userID`'s cached sessions, or every cached session if `userID` is None
+
+		:param userID: user id. Optional.
+		:return:
+		"""
+		with self._lock:
+			if userID is None:
+				self._generation += 1
+				self.sessions.clear()
+			else:
+				userID = int(userID)
+				self._bump(userID)
+				self.sessions.pop(userID, None)
+
+	def warm(self, count=1000):
+		"""
+		Fill the cache with every bancho session stored in redis.
+		Uses SCAN/SSCAN so redis is never blocked. Call it on startup.
+
+		:param count: SCAN/SSCAN batch size hint. Default: 1000.
+		:return: number of cached users
+		"""
+		with self._lock:
+			generation = self._generation
+			generations = dict(self.generations)
+		expire = time.time() + self.ttl
+		sessions = {}
+		for key in glob.redis.scan_iter(match="peppy:sessions:*", count=count):
+			key = key.decode("utf-8")
+			try:
+				userID = int(key.split(":")[-1])
+			except ValueError:
+				continue
+			sessions[userID] = (
+				frozenset(x.decode("utf-8") for x in glob.redis.sscan_iter(key, count=count)),
+				expire
+			)
+		with self._lock:
+			if self._generation != generation:
+				# The whole cache was invalidated while warming it
+				sessions = {}
+			for userID, entry in sessions.items():
+				if self.generations.get(userID, 0) == generations.get(userID, 0):
+					self.sessions[userID] = entry
+		log.debug("Warmed bancho sessions cache with {} users".format(len(sessions)))
+		return len(sessions)
+
+class invalidationHandler(generalPubSubHandler.generalPubSubHandler):
+	"""
+	PubSub handler that invalidates the local bancho sessions cache.
+	Subscribe it to `INVALIDATE_CHANNEL`.
+	"""
+	def __init__(self):
+		super().__init__()
+		self.type = "int"
+
+	def handle(self, data):
+		data = super().parseData(data)
+		if data is None:
+			return
+		cache.invalidate(data)
+
+# Shared sessions cache, disabled by default
+cache = sessionsCache()
@@ -1,5 +1,6 @@
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor
 try:
 	from pymysql.err import ProgrammingError
 except ImportError:
@@ -10,7 +11,8 @@ from common import generalUtils
 from common.constants import gameModes
 from common.constants import privileges
 from common.log import logUtils as log
-from common.ripple import passwordUtils, scoreUtils
+from common.redis import batchPublisher, generalPubSubHandler, redisBatch, streams
+from common.ripple import passwordUtils, scoreUtils, sessionsCache
 from objects import glob
 
 
@@ -46,6 +48,71 @@ def getUserStats(userID, gameMode, *, relax=False):
 	# Return stats + game rank
 	return stats
 
+def getUserStatsAllModes(userID):
+	"""
+	Get all user stats for every game mode, both classic and relax.
+	Same as calling `getUserStats` 8 times, but it runs only
+	one query per table and resolves all game ranks in one redis pipeline.
+
+	:param userID: user id
+	:return: dictionary with the following structure:
+	```
+	{
+		"classic": [std stats, taiko stats, ctb stats, mania stats],
+		"relax": [std stats, taiko stats, ctb stats, mania stats]
+	}
+	```
+	Where each element has the same keys as `getUserStats`' result.
+	None if the user doesn't have stats.
+	"""
+	modes = (gameModes.STD, gameModes.TAIKO, gameModes.CTB, gameModes.MANIA)
+	columns = ", ".join(
+		"ranked_score_{gm}, avg_accuracy_{gm}, playcount_{gm}, total_score_{gm}, pp_{gm}".format(
+			gm=gameModes.getGameModeForDB(x)
+		) for x in modes
+	)
+
+	# Get stats (one query per table)
+	rows = {}
+	for relax in (False, True):
+		rows[relax] = glob.db.fetch(
+			"SELECT {columns} FROM {table} WHERE id = %s LIMIT 1".format(
+				columns=columns,
+				table="users_stats_relax" if relax else "users_stats"
+			),
+			(userID,)
+		)
+		if rows[relax] is None:
+			return None
+
+	# Get all game ranks
+	pipe = glob.redis.pipeline()
+	for relax in (False, True):
+		for gameMode in modes:
+			k = "ripple:leaderboard:{}".format(gameModes.getGameModeForDB(gameMode))
+			if relax:
+				k += ":relax"
+			pipe.zrevrank(k, userID)
+	positions = iter(pipe.execute())
+
+	# Build per-mode stats
+	result = {}
+	for relax in (False, True):
+		row = rows[relax]
+		result["relax" if relax else "classic"] = modeStats = []
+		for gameMode in modes:
+			gm = gameModes.getGameModeForDB(gameMode)
+			position = next(positions)
+			modeStats.append({
+				"rankedScore": row["ranked_score_{}".format(gm)],
+				"accuracy": row["avg_accuracy_{}".format(gm)],
+				"playcount": row["playcount_{}".format(gm)],
+				"totalScore": row["total_score_{}".format(gm)],
+				"pp": row["pp_{}".format(gm)],
+				"gameRank": 0 if position is None else int(position) + 1
+			})
+	return result
+
 def getIDSafe(_safeUsername):
 	"""
 	Get user ID from a safe username
@@ -78,7 +145,7 @@ def getID(username):
 			return 0
 
 		# Otherwise, save it in redis and return it
-		glob.redis.set("ripple:userid_cache:{}".format(usernameSafe), userID, 3600)	# expires in 1 hour
+		redisBatch.call("set", "ripple:userid_cache:{}".format(usernameSafe), userID, 3600)	# expires in 1 hour
 		return userID
 
 	# Return userid from redis
@@ -501,6 +568,8 @@ def checkBanchoSession(userID, ip=""):
 	:param ip: ip address. Optional. Default: empty string
 	:return: True if there's an active bancho session, else False
 	"""
+	if sessionsCache.cache.enabled:
+		return sessionsCache.cache.contains(userID, ip)
 	if ip != "":
 		return glob.redis.sismember("peppy:sessions:{}".format(userID), ip)
 	return glob.redis.exists("peppy:sessions:{}".format(userID))
@@ -529,6 +598,113 @@ def check2FA(userID, ip):
 		return False
 	return glob.db.fetch("SELECT id FROM ip_user WHERE userid = %s AND ip = %s LIMIT 1", (userID, ip)) is None
 
+# Users state (privileges, silence end and username) materialized in redis,
+# used by the chat and presence hot paths instead of querying the db.
+# Changes made to `users` by other services are visible after at most USERS_STATE_TTL seconds,
+# or right away if they publish `peppy:ban` (see usersStateInvalidationHandler).
+USERS_STATE_TTL = 60
+
+def _usersStateKey(userID):
+	return "ripple:users_state:{}".format(userID)
+
+def _saveUsersState(pipe, userID, state):
+	"""
+	Queue the commands needed to materialize a user's state in redis
+
+	:param pipe: redis pipeline
+	:param userID: user id
+	:param state: dictionary with `privileges`, `silence_end` and `username` keys
+	:return:
+	"""
+	k = _usersStateKey(userID)
+	pipe.hset(k, mapping={
+		"privileges": state["privileges"],
+		"silence_end": state["silence_end"],
+		"username": state["username"]
+	})
+	pipe.expire(k, USERS_STATE_TTL)
+
+def refreshUsersState(userID):
+	"""
+	Read `userID`'s privileges, silence end and username from db and
+	materialize them in redis. Call this after changing any of them.
+
+	:param userID: user id
+	:return: dictionary with `privileges`, `silence_end` and `username` keys or None if the user doesn't exist
+	"""
+	state = glob.db.fetch(
+		"SELECT `privileges`, silence_end, username FROM users WHERE id = %s LIMIT 1",
+		(userID,)
+	)
+	pipe = glob.redis.pipeline()
+	if state is None:
+		pipe.delete(_usersStateKey(userID))
+	else:
+		_saveUsersState(pipe, userID, state)
+	pipe.execute()
+	return state
+
+def getUsersState(userID):
+	"""
+	Get `userID`'s privileges, silence end and username from redis.
+	Falls back to the db only if they are not in redis.
+	Other services change `users` directly, so this can be up to `USERS_STATE_TTL` seconds stale
+	(unless they publish `peppy:ban`). Use it only in read paths (chat, presence),
+	never to decide whether to write something.
+
+	:param userID: user id
+	:return: dictionary with `privileges`, `silence_end` and `username` keys or None if the user doesn't exist
+	"""
+	state = glob.redis.hgetall(_usersStateKey(userID))
+	if not state:
+		return refreshUsersState(userID)
+	return {
+		"privileges": int(state[b"privileges"]),
+		"silence_end": int(state[b"silence_end"]),
+		"username": state[b"username"].decode("utf-8")
+	}
+
+class usersStateInvalidationHandler(generalPubSubHandler.generalPubSubHandler):
+	"""
+	PubSub handler that drops a user's redis state, so it's read again from the db.
+	Subscribe it to `peppy:ban`, to see privileges changed by other services right away.
+	"""
+	def __init__(self):
+		super().__init__()
+		self.type = "int"
+
+	def handle(self, data):
+		data = super().parseData(data)
+		if data is None:
+			return
+		glob.redis.delete(_usersStateKey(data))
+
+def rebuildUsersState(chunkSize=1000):
+	"""
+	Rebuild the redis users state of every user from the db.
+	Used to reconcile redis with changes made to `users` by other services.
+
+	:param chunkSize: number of users read from the db and written to redis at once. Default: 1000.
+	:return: number of users
+	"""
+	total = 0
+	lastID = 0
+	while True:
+		users = glob.db.fetchAll(
+			"SELECT id, `privileges`, silence_end, username FROM users WHERE id > %s ORDER BY id LIMIT %s",
+			(lastID, chunkSize)
+		)
+		if not users:
+			break
+		pipe = glob.redis.pipeline(transaction=False)
+		for user in users:
+			_saveUsersState(pipe, user["id"], user)
+		pipe.execute()
+		lastID = users[-1]["id"]
+		total += len(users)
+	log.info("Rebuilt users state for {} users".format(total))
+	return total
+
 def isAllowed(userID):
 	"""
 	Check if userID is not banned or restricted
@@ -541,14 +717,19 @@ def isAllowed(userID):
 		return False
 	return (result["privileges"] & (privileges.USER_NORMAL | privileges.USER_PUBLIC)) > 0
 
-def isRestricted(userID):
+def isRestricted(userID, cached=False):
 	"""
 	Check if userID is restricted
 
 	:param userID: user id
+	:param cached: if True, read the (possibly stale) redis users state instead of the db.
+				   Use it only in chat/presence read paths. Default: False.
 	:return: True if not restricted, otherwise false.
 	"""
-	result = glob.db.fetch("SELECT `privileges` FROM users WHERE id = %s LIMIT 1", (userID,))
+	if cached:
+		result = getUsersState(userID)
+	else:
+		result = glob.db.fetch("SELECT `privileges` FROM users WHERE id = %s LIMIT 1", (userID,))
 	if result is None:
 		return False
 	return (result["privileges"] & privileges.USER_NORMAL) and not (result["privileges"] & privileges.USER_PUBLIC)
@@ -579,11 +760,25 @@ def isLocked(userID):
 		(result["privileges"] & privileges.USER_PUBLIC > 0) and (result["privileges"] & privileges.USER_NORMAL == 0)
 	)
 
-def ban(userID):
+def _publishBan(userID, batch):
+	"""
+	Notify bancho that `userID`'s privileges have changed
+
+	:param userID: user id
+	:param batch: if True, publish through the shared batch publisher
+	:return:
+	"""
+	if batch:
+		batchPublisher.publisher.publish("peppy:ban", userID)
+	else:
+		streams.publish("peppy:ban", userID)
+
+def ban(userID, batch=False):
 	"""
 	Ban userID
 
 	:param userID: user id
+	:param batch: if True, notify bancho through the shared batch publisher. Use it for mass actions.
 	:return:
 	"""
 	# Set user as banned in db
@@ -592,31 +787,35 @@ def ban(userID):
 		"UPDATE users SET `privileges` = `privileges` & %s, ban_datetime = %s WHERE id = %s LIMIT 1",
 		(~(privileges.USER_NORMAL | privileges.USER_PUBLIC), banDateTime, userID)
 	)
+	refreshUsersState(userID)
 
 	# Notify bancho about the ban
-	glob.redis.publish("peppy:ban", userID)
+	_publishBan(userID, batch)
 
 	# Remove the user from global and country leaderboards
 	removeFromLeaderboard(userID)
 
-def unban(userID):
+def unban(userID, batch=False):
 	"""
 	Unban userID
 
 	:param userID: user id
+	:param batch: if True, notify bancho through the shared batch publisher. Use it for mass actions.
 	:return:
 	"""
 	glob.db.execute(
 		"UPDATE users SET `privileges` = `privileges` | %s, ban_datetime = 0 WHERE id = %s LIMIT 1",
 		((privileges.USER_NORMAL | privileges.USER_PUBLIC), userID)
 	)
-	glob.redis.publish("peppy:ban", userID)
+	refreshUsersState(userID)
+	_publishBan(userID, batch)
 
-def restrict(userID):
+def restrict(userID, batch=False):
 	"""
 	Restrict userID
 
 	:param userID: user id
+	:param batch: if True, notify bancho through the shared batch publisher. Use it for mass actions.
 	:return:
 	"""
 	if isRestricted(userID):
@@ -627,22 +826,24 @@ def restrict(userID):
 		"UPDATE users SET `privileges` = `privileges` & %s, ban_datetime = %s WHERE id = %s LIMIT 1",
 		(~privileges.USER_PUBLIC, banDateTime, userID)
 	)
+	refreshUsersState(userID)
 
 	# Notify bancho about this ban
-	glob.redis.publish("peppy:ban", userID)
+	_publishBan(userID, batch)
 
 	# Remove the user from global and country leaderboards
 	removeFromLeaderboard(userID)
 
-def unrestrict(userID):
+def unrestrict(userID, batch=False):
 	"""
 	Unrestrict userID.
 	Same as unban().
 
 	:param userID: user id
+	:param batch: if True, notify bancho through the shared batch publisher. Use it for mass actions.
 	:return:
 	"""
-	unban(userID)
+	unban(userID, batch)
 
 def appendNotes(userID, notes, addNl=True, trackDate=True):
 	"""
@@ -672,14 +873,18 @@ def getPrivileges(userID):
 		return 0
 	return result["privileges"]
 
-def getSilenceEnd(userID):
+def getSilenceEnd(userID, cached=False):
 	"""
 	Get userID's **ABSOLUTE** silence end UNIX time
 	Remember to subtract time.time() if you want to get the actual silence time
 
 	:param userID: user id
+	:param cached: if True, read the (possibly stale) redis users state instead of the db.
+				   Use it only in chat/presence read paths. Default: False.
 	:return: UNIX time
 	"""
+	if cached:
+		return getUsersState(userID)["silence_end"]
 	return glob.db.fetch("SELECT silence_end FROM users WHERE id = %s LIMIT 1", (userID,))["silence_end"]
 
 def silence(userID, seconds, silenceReason, author = 999):
@@ -699,9 +904,13 @@ def silence(userID, seconds, silenceReason, author = 999):
 		(silenceEndTime, silenceReason, userID)
 	)
 
+	# Update redis state. This gives us the username for the log as well.
+	state = refreshUsersState(userID)
+	if state is None:
+		return
+
 	# Log
-	targetUsername = getUsername(userID)
-	# TODO: exists check im drunk rn i need to sleep (stampa piede ubriaco confirmed)
+	targetUsername = state["username"]
 	if seconds > 0:
 		log.rap(author, "has silenced {} for {} seconds for the following reason: \"{}\"".format(targetUsername, seconds, silenceReason), True)
 	else:
@@ -866,7 +1075,11 @@ def saveBanchoSession(userID, ip):
 	:param ip: IP address
 	:return:
 	"""
-	glob.redis.sadd("peppy:sessions:{}".format(userID), ip)
+	pipe = glob.redis.pipeline()
+	pipe.sadd("peppy:sessions:{}".format(userID), ip)
+	pipe.publish(sessionsCache.INVALIDATE_CHANNEL, userID)
+	pipe.execute()
+	sessionsCache.cache.add(userID, ip)
 
 def deleteBanchoSessions(userID, ip):
 	"""
@@ -876,7 +1089,11 @@ def deleteBanchoSessions(userID, ip):
 	:param ip: IP address
 	:return:
 	"""
-	glob.redis.srem("peppy:sessions:{}".format(userID), ip)
+	pipe = glob.redis.pipeline()
+	pipe.srem("peppy:sessions:{}".format(userID), ip)
+	pipe.publish(sessionsCache.INVALIDATE_CHANNEL, userID)
+	pipe.execute()
+	sessionsCache.cache.remove(userID, ip)
 
 def setPrivileges(userID, priv):
 	"""
@@ -887,6 +1104,7 @@ def setPrivileges(userID, priv):
 	:return:
 	"""
 	glob.db.execute("UPDATE users SET `privileges` = %s WHERE id = %s LIMIT 1", (priv, userID))
+	refreshUsersState(userID)
 
 def getGroupPrivileges(groupName):
 	"""
@@ -1052,6 +1270,7 @@ def resetPendingFlag(userID, success=True):
 			"UPDATE users SET `privileges` = `privileges` | %s WHERE id = %s LIMIT 1",
 			((privileges.USER_PUBLIC | privileges.USER_NORMAL), userID)
 		)
+	refreshUsersState(userID)
 
 def verifyUser(userID, hashes):
 	"""
@@ -1204,9 +1423,12 @@ def changeUsername(userID=0, oldUsername="", newUsername=""):
 	glob.db.execute("UPDATE users_stats SET username = %s WHERE id = %s LIMIT 1", (newUsername, userID))
 
 	# Empty redis username cache
-	# TODO: Le pipe woo woo
-	glob.redis.delete("ripple:userid_cache:{}".format(safeUsername(oldUsername)))
-	glob.redis.delete("ripple:change_username_pending:{}".format(userID))
+	redisBatch.call(
+		"delete",
+		"ripple:userid_cache:{}".format(safeUsername(oldUsername)),
+		"ripple:change_username_pending:{}".format(userID),
+		_usersStateKey(userID)
+	)
 
 def removeFromLeaderboard(userID):
 	"""
@@ -1217,11 +1439,12 @@ def removeFromLeaderboard(userID):
 	"""
 	# Remove the user from global and country leaderboards, for every mode
 	country = getCountry(userID).lower()
-	for mode in ("std", "taiko", "ctb", "mania"):
-		for suffix in ("", ":relax"):
-			glob.redis.zrem("ripple:leaderboard:{}{}".format(mode, suffix), str(userID))
-			if country is not None and len(country) > 0 and country != "xx":
-				glob.redis.zrem("ripple:leaderboard:{}:{}{}".format(mode, country, suffix), str(userID))
+	with redisBatch.batch():
+		for mode in ("std", "taiko", "ctb", "mania"):
+			for suffix in ("", ":relax"):
+				redisBatch.call("zrem", "ripple:leaderboard:{}{}".format(mode, suffix), str(userID))
+				if country is not None and len(country) > 0 and country != "xx":
+					redisBatch.call("zrem", "ripple:leaderboard:{}:{}{}".format(mode, country, suffix), str(userID))
 
 def deprecateTelegram2Fa(userID):
 	"""
@@ -1249,6 +1472,85 @@ def unlockAchievement(userID, achievementID):
 		(userID, achievementID, int(time.time()))
 	)
 
+def unlockAchievements(userID, achievementIDs, updateVersion=True):
+	"""
+	Unlock multiple achievements for `userID` with a single query.
+	Already unlocked achievements are ignored.
+
+	:param userID: user id
+	:param achievementIDs: iterable of achievement ids
+	:param updateVersion: if True, set `userID`'s achievements version to
+						  `glob.ACHIEVEMENTS_VERSION` in the same transaction. Default: True.
+	:return:
+	"""
+	achievementIDs = list(achievementIDs)
+	queries = []
+	if achievementIDs:
+		now = int(time.time())
+		params = []
+		for achievementID in achievementIDs:
+			params.extend((userID, achievementID, now))
+		queries.append((
+			"INSERT IGNORE INTO users_achievements (user_id, achievement_id, `time`) VALUES {}".format(
+				", ".join(["(%s, %s, %s)"] * len(achievementIDs))
+			),
+			params
+		))
+	if updateVersion:
+		queries.append((
+			"UPDATE users SET achievements_version = %s WHERE id = %s LIMIT 1",
+			(glob.ACHIEVEMENTS_VERSION, userID)
+		))
+	if queries:
+		glob.db.transaction(queries)
+
+def backfillAchievements(getAchievements, chunkSize=500, workers=4, progressCallback=None):
+	"""
+	Unlock achievements for every user whose achievements version is older than `glob.ACHIEVEMENTS_VERSION`.
+	Users are streamed from the db in chunks of `chunkSize` and each chunk is processed
+	by at most `workers` threads at the same time.
+
+	:param getAchievements: function that accepts a user id and returns the list of achievement ids to unlock
+	:param chunkSize: number of users fetched from the db at once. Default: 500.
+	:param workers: max number of users processed concurrently. Default: 4.
+	:param progressCallback: function called after every chunk with (processed users, total users). Optional.
+	:return: number of processed users
+	"""
+	total = glob.db.fetch(
+		"SELECT COUNT(*) AS count FROM users WHERE achievements_version < %s",
+		(glob.ACHIEVEMENTS_VERSION,)
+	)["count"]
+	log.info("Backfilling achievements for {} users".format(total))
+
+	def process(userID):
+		unlockAchievements(userID, getAchievements(userID))
+
+	processed = 0
+	lastID = 0
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		while True:
+			users = glob.db.fetchAll(
+				"SELECT id FROM users WHERE id > %s AND achievements_version < %s ORDER BY id LIMIT %s",
+				(lastID, glob.ACHIEVEMENTS_VERSION, chunkSize)
+			)
+			if not users:
+				break
+			lastID = users[-1]["id"]
+
+			# Wait for the whole chunk before fetching the next one,
+			# so we never have more than `chunkSize` users in memory
+			for userID, future in [(x["id"], executor.submit(process, x["id"])) for x in users]:
+				try:
+					future.result()
+				except Exception as e:
+					log.error("Error while backfilling achievements for user {}: {}".format(userID, e))
+			processed += len(users)
+
+			log.info("Backfilled achievements for {}/{} users".format(processed, total))
+			if callable(progressCallback):
+				progressCallback(processed, total)
+	return processed
+
 def getAchievementsVersion(userID):
 	result = glob.db.fetch("SELECT achievements_version FROM users WHERE id = %s LIMIT 1", (userID,))
 	if result is None:
@@ -32,6 +32,29 @@ def capture():
 	return decorator
 
 
+def captureAsync():
+	"""
+	Same as `capture`, but for coroutine functions:
+	```
+	@sentry.captureAsync()
+	async def blablabla():
+		...
+	```
+
+	:return:
+	"""
+	def decorator(func):
+		async def wrapper(*args, **kwargs):
+			try:
+				return await func(*args, **kwargs)
+			except:
+				log.error("Unhandled exception!\n```\n{}\n{}```".format(sys.exc_info(), traceback.format_exc()))
+				if glob.conf.sentry_enabled:
+					glob.application.sentry_client.captureException()
+		return wrapper
+	return decorator
+
+
 def captureTornado(func):
 	"""
 	Capture an exception asynchronously in a tornado handler.
@@ -0,0 +1,213 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+from common.log import logUtils as log
+from objects import glob
+
+# Returned by `get*` methods when nothing is cached. `None` means "cached as missing".
+MISS = object()
+
+class lruCache:
+	"""
+	Thread safe, size bounded LRU cache with per entry expiration
+	"""
+	def __init__(self, maxSize):
+		"""
+		:param maxSize: max number of entries. The least recently used ones are evicted first.
+		"""
+		self.maxSize = maxSize
+		self.entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		"""
+		Return the value cached for `key`
+
+		:param key: key
+		:return: cached value, or `MISS`
+		"""
+		with self._lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				return MISS
+			if entry[1] <= time.time():
+				del self.entries[key]
+				return MISS
+			self.entries.move_to_end(key)
+			return entry[0]
+
+	def set(self, key, value, ttl):
+		"""
+		Cache `value` for `ttl` seconds
+
+		:param key: key
+		:param value: value
+		:param ttl: seconds
+		:return:
+		"""
+		with self._lock:
+			self.entries[key] = (value, time.time() + ttl)
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.maxSize:
+				self.entries.popitem(last=False)
+
+	def delete(self, key):
+		with self._lock:
+			self.entries.pop(key, None)
+
+	def clear(self):
+		with self._lock:
+			self.entries.clear()
+
+	def __len__(self):
+		return len(self.entries)
+
+class beatmapsCache:
+	"""
+	Two level (in-process LRU + optional redis) cache of cheesegull beatmap sets.
+	Every cached set also fills a beatmapID -> setID index from its `ChildrenBeatmaps`,
+	so `cheesegull.getBeatmap` can be served without any http request.
+	IDs that don't exist are cached as `None`, for a shorter time.
+	"""
+	def __init__(self, maxSize=10000, ttl=300, negativeTtl=30):
+		"""
+		Initialize an in-process only beatmaps cache. Call `enableRedis()` to add the redis tier.
+
+		:param maxSize: max number of cached sets and max number of cached beatmap ids. Default: 10000.
+		:param ttl: seconds after which a set is fetched again from cheesegull. Default: 300.
+		:param negativeTtl: seconds after which a missing set/beatmap is looked up again. Default: 30.
+		"""
+		self.ttl = ttl
+		self.negativeTtl = negativeTtl
+		self.sets = lruCache(maxSize)
+		self.beatmaps = lruCache(maxSize)
+		self.redis = None
+
+	def enableRedis(self, r=None):
+		"""
+		Share cached sets with other processes through redis
+
+		:param r: redis connection. Optional. Default: glob.redis.
+		:return:
+		"""
+		self.redis = r if r is not None else glob.redis
+
+	@staticmethod
+	def _setKey(setID):
+		return "ripple:cheesegull:set:{}".format(setID)
+
+	@staticmethod
+	def _beatmapKey(beatmapID):
+		return "ripple:cheesegull:beatmap:{}".format(beatmapID)
+
+	def _ttl(self, value):
+		return self.ttl if value is not None else self.negativeTtl
+
+	def _redisGet(self, key):
+		if self.redis is None:
+			return MISS
+		try:
+			value = self.redis.get(key)
+		except redis.RedisError as e:
+			log.warning("Beatmaps cache redis error ({})".format(e))
+			return MISS
+		if value is None:
+			return MISS
+		return json.loads(value)
+
+	def _redisSet(self, items):
+		if self.redis is None:
+			return
+		try:
+			pipe = self.redis.pipeline(transaction=False)
+			for key, value in items:
+				pipe.set(key, json.dumps(value), ex=self._ttl(value))
+			pipe.execute()
+		except redis.RedisError as e:
+			log.warning("Beatmaps cache redis error ({})".format(e))
+
+	def _get(self, local, key, redisKey):
+		value = local.get(key)
+		if value is not MISS:
+			glob.dog.increment(glob.DATADOG_PREFIX + ".beatmaps_cache", tags=["result:hit", "tier:local"])
+			return value
+		value = self._redisGet(redisKey)
+		if value is not MISS:
+			glob.dog.increment(glob.DATADOG_PREFIX + ".beatmaps_cache", tags=["result:hit", "tier:redis"])
+			local.set(key, value, self._ttl(value))
+			return value
+		glob.dog.increment(glob.DATADOG_PREFIX + ".beatmaps_cache", tags=["result:miss"])
+		return MISS
+
+	def getSet(self, setID):
+		"""
+		Return a cached cheesegull set
+
+		:param setID: beatmap set id
+		:return: set dict, `None` if the set doesn't exist, or `MISS`
+		"""
+		setID = int(setID)
+		return self._get(self.sets, setID, self._setKey(setID))
+
+	def getSetID(self, beatmapID):
+		"""
+		Return the cached set id of a beatmap
+
+		:param beatmapID: beatmap id
+		:return: set id, `None` if the beatmap doesn't exist, or `MISS`
+		"""
+		beatmapID = int(beatmapID)
+		return self._get(self.beatmaps, beatmapID, self._beatmapKey(beatmapID))
+
+	def setSet(self, setID, data):
+		"""
+		Cache a cheesegull set and index its children beatmaps
+
+		:param setID: beatmap set id
+		:param data: set dict, or None if the set doesn't exist
+		:return:
+		"""
+		setID = int(setID)
+		items = [(self._setKey(setID), data)]
+		self.sets.set(setID, data, self._ttl(data))
+		if data is not None:
+			for beatmap in data.get("ChildrenBeatmaps") or []:
+				if "BeatmapID" not in beatmap:
+					continue
+				self.beatmaps.set(beatmap["BeatmapID"], setID, self.ttl)
+				items.append((self._beatmapKey(beatmap["BeatmapID"]), setID))
+		self._redisSet(items)
+
+	def setSetID(self, beatmapID, setID):
+		"""
+		Cache a beatmap's set id
+
+		:param beatmapID: beatmap id
+		:param setID: set id, or None if the beatmap doesn't exist
+		:return:
+		"""
+		beatmapID = int(beatmapID)
+		self.beatmaps.set(beatmapID, setID, self._ttl(setID))
+		self._redisSet([(self._beatmapKey(beatmapID), setID)])
+
+	def invalidateSet(self, setID):
+		"""
+		Drop a cached set (but not its beatmaps, their set id doesn't change)
+
+		:param setID: beatmap set id
+		:return:
+		"""
+		setID = int(setID)
+		self.sets.delete(setID)
+		if self.redis is not None:
+			try:
+				self.redis.delete(self._setKey(setID))
+			except redis.RedisError as e:
+				log.warning("Beatmaps cache redis error ({})".format(e))
+
+# Shared beatmaps cache, in-process only by default
+cache = beatmapsCache()
@@ -1,12 +1,85 @@
-import requests
+import concurrent.futures
 import json
 
+import requests
+
 from constants import exceptions
 from objects import glob
 from common.log import logUtils as log
-from objects import glob
+from common.web import beatmapsCache, httpClient, listingCache
+from common.web.singleFlight import singleFlight
+
+# Concurrent identical requests are sent only once
+flights = singleFlight(timeout=30)
+
+class cheesegullError(Exception):
+	"""
+	Raised when cheesegull couldn't be reached or returned an error,
+	as opposed to returning "not found" (None). Failures must not be cached.
+	"""
+	pass
+
+def _flightKey(*args):
+	return json.dumps(args, sort_keys=True, default=str)
+
+def _request(handler, requestType="GET", key="", params=None, mustHave=None, wants=None):
+	"""
+	Send a request to Cheesegull.
+	If an identical request is already in flight, wait for its result instead of sending another one.
+	Same arguments and return value as `_cheesegullRequest`.
+
+	:raises cheesegullError: if the request failed, or the identical request in flight didn't complete in time
+	"""
+	args = (handler, requestType, key, params, mustHave, wants)
+	try:
+		return flights.do(_flightKey(*args), _cheesegullRequest, *args)
+	except concurrent.futures.TimeoutError:
+		log.warning("Cheesegull request timed out ({})".format(handler))
+		raise cheesegullError("Timed out")
 
 def cheesegullRequest(handler, requestType="GET", key="", params=None, mustHave=None, wants=None):
+	"""
+	Send a request to Cheesegull.
+	If an identical request is already in flight, wait for its result instead of sending another one.
+	Same arguments as `_cheesegullRequest`.
+
+	:return: same as `_cheesegullRequest`, or None if the request failed
+	"""
+	try:
+		return _request(handler, requestType, key, params, mustHave, wants)
+	except cheesegullError:
+		return None
+
+async def cheesegullRequestAsync(handler, requestType="GET", key="", params=None, mustHave=None, wants=None, executor=None):
+	"""
+	Same as `cheesegullRequest`, but the request is sent from `executor` and awaited
+
+	:param executor: executor that sends the request. Optional. Default: the event loop's default executor.
+	"""
+	args = (handler, requestType, key, params, mustHave, wants)
+	try:
+		return await flights.doAsync(_flightKey(*args), _cheesegullRequest, *args, executor=executor)
+	except concurrent.futures.TimeoutError:
+		log.warning("Cheesegull request timed out ({})".format(handler))
+		return None
+	except cheesegullError:
+		return None
+
+async def _callAsync(func, *args, executor=None):
+	"""
+	Run `func(*args)` in `executor` and await it, sharing the result with identical concurrent calls
+
+	:param func: blocking cheesegull function
+	:param executor: executor. Optional. Default: the event loop's default executor.
+	:return: `func`'s return value, or None if it timed out
+	"""
+	try:
+		return await flights.doAsync(_flightKey(func.__name__, *args), func, *args, executor=executor)
+	except concurrent.futures.TimeoutError:
+		log.warning("Cheesegull request timed out ({})".format(func.__name__))
+		return None
+
+def _cheesegullRequest(handler, requestType="GET", key="", params=None, mustHave=None, wants=None):
 	"""
 	Send a request to Cheesegull
 
@@ -16,9 +89,10 @@ def cheesegullRequest(handler, requestType="GET", key="", params=None, mustHave=
 	:param params: dictionary containing get/post form parameters. Optional.
 	:param mustHave: list or string containing the key(s) that must be contained in the json response. Optional.
 	:param wants: can be a single string, or a list of strings.
-	:return:    returns None if the result was invalid or if the request failed.
+	:return:    returns None if cheesegull returned 404 (or null) or a response without the required keys.
 				if `wants` is a string, returns the key from the response.
 				if `wants` is a list of strings, return a dictionary containing the wanted keys.
+	:raises cheesegullError: if the request failed, or cheesegull returned an error or invalid json
 	"""
 	# Default values
 	if mustHave is None:
@@ -32,26 +106,37 @@ def cheesegullRequest(handler, requestType="GET", key="", params=None, mustHave=
 	postData = None
 	getParams = None
 	if requestType.lower() == "post":
-		f = requests.post
+		f = httpClient.post
 		postData = params
 	else:
-		f = requests.get
+		f = httpClient.get
 		getParams = params
-	result = f("{}/{}".format(glob.conf["CHEESEGULL_API_URL"], handler), params=getParams, data=postData, headers= {
-		"Authorization": key
-	})
+	try:
+		result = f("{}/{}".format(glob.conf["CHEESEGULL_API_URL"], handler), params=getParams, data=postData, headers= {
+			"Authorization": key
+		}, retries=httpClient.RETRIES)
+	except requests.RequestException as e:
+		log.warning("Cheesegull request failed ({})".format(e))
+		raise cheesegullError(str(e))
 
 	log.debug(result.url)
 	# log.debug(str(result.text))
 
+	# Status check
+	if result.status_code == 404:
+		return None
+	if result.status_code != 200:
+		log.warning("Cheesegull returned {} ({})".format(result.status_code, handler))
+		raise cheesegullError("HTTP {}".format(result.status_code))
+
 	try:
 		data = json.loads(result.text)
 	except (json.JSONDecodeError, ValueError, requests.RequestException, KeyError, exceptions.noAPIDataError):
+		raise cheesegullError("Invalid json")
+	if data is None:
 		return None
 
-	# Params and status check
-	if result.status_code != 200:
-		return None
+	# Params check
 	if mustHave is not None:
 		if type(mustHave) == str:
 			mustHave = [mustHave]
@@ -73,7 +158,7 @@ def cheesegullRequest(handler, requestType="GET", key="", params=None, mustHave=
 				res[i] = data[i]
 		return res
 
-def getListing(rankedStatus, page, gameMode, query):
+def _fetchListing(rankedStatus, page, gameMode, query):
 	glob.dog.increment(glob.DATADOG_PREFIX + ".cheesegull_requests", tags=["cheesegull:listing"])
 	params = {
 		"query": query,
@@ -86,17 +171,84 @@ def getListing(rankedStatus, page, gameMode, query):
 		params["mode"] = gameMode
 	return cheesegullRequest("search", params=params)
 
+def _getListingEntry(rankedStatus, page, gameMode, query):
+	query = listingCache.normalizeQuery(query)
+	return listingCache.cache.get(
+		listingCache.listingCache.listingKey(rankedStatus, page, gameMode, query),
+		lambda: _fetchListing(rankedStatus, page, gameMode, query)
+	)
+
+def getListing(rankedStatus, page, gameMode, query):
+	"""
+	Return an osu!direct listing, from cache if possible (see `listingCache`).
+	The returned list is shared with other callers, don't modify it.
+
+	:return: cheesegull's search json, or None if the request failed
+	"""
+	entry = _getListingEntry(rankedStatus, page, gameMode, query)
+	return entry.data if entry is not None else None
+
+def getListingDirect(rankedStatus, page, gameMode, query):
+	"""
+	Same as `getListing`, but returns the `toDirect` rows of the listing's sets.
+	Sets that can't be converted are skipped. Rows are cached along with the listing.
+
+	:return: list of osu!direct rows, or None if the request failed
+	"""
+	entry = _getListingEntry(rankedStatus, page, gameMode, query)
+	if entry is None:
+		return None
+	if entry.rendered is None:
+		rows = []
+		for beatmapSet in entry.data:
+			try:
+				rows.append(toDirect(beatmapSet))
+			except (ValueError, KeyError):
+				continue
+		entry.rendered = rows
+	return entry.rendered
+
 def getBeatmapSet(id):
+	data = beatmapsCache.cache.getSet(id)
+	if data is not beatmapsCache.MISS:
+		return data
 	glob.dog.increment(glob.DATADOG_PREFIX + ".cheesegull_requests", tags=["cheesegull:set"])
-	return cheesegullRequest("s/{}".format(id))
+	try:
+		data = _request("s/{}".format(id))
+	except cheesegullError:
+		# Don't cache failures as missing sets
+		return None
+	beatmapsCache.cache.setSet(id, data)
+	return data
 
 def getBeatmap(id):
-	glob.dog.increment(glob.DATADOG_PREFIX + ".cheesegull_requests", tags=["cheesegull:beatmap"])
-	setID = cheesegullRequest("b/{}".format(id), wants="ParentSetID")
-	if setID is None or setID <= 0:
+	setID = beatmapsCache.cache.getSetID(id)
+	if setID is beatmapsCache.MISS:
+		glob.dog.increment(glob.DATADOG_PREFIX + ".cheesegull_requests", tags=["cheesegull:beatmap"])
+		try:
+			setID = _request("b/{}".format(id), wants="ParentSetID")
+		except cheesegullError:
+			# Don't cache failures as missing beatmaps
+			return None
+		if setID is not None and setID <= 0:
+			setID = None
+		beatmapsCache.cache.setSetID(id, setID)
+	if setID is None:
 		return None
 	return getBeatmapSet(setID)
 
+async def getListingAsync(rankedStatus, page, gameMode, query, executor=None):
+	return await _callAsync(getListing, rankedStatus, page, gameMode, query, executor=executor)
+
+async def getListingDirectAsync(rankedStatus, page, gameMode, query, executor=None):
+	return await _callAsync(getListingDirect, rankedStatus, page, gameMode, query, executor=executor)
+
+async def getBeatmapSetAsync(id, executor=None):
+	return await _callAsync(getBeatmapSet, id, executor=executor)
+
+async def getBeatmapAsync(id, executor=None):
+	return await _callAsync(getBeatmap, id, executor=executor)
+
 def updateBeatmap(setID):
 	# This has been deprecated
 	return
@@ -157,4 +309,4 @@ def directToApiStatus(directStatus):
 	elif directStatus == 4:
 		return None
 	else:
-		return 1
\ No newline at end of file
+		return 1
\ No newline at end of file
@@ -0,0 +1,119 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+import requests.adapters
+from urllib3.util.retry import Retry
+
+from objects import glob
+
+# Default (connect, read) timeouts, in seconds
+DEFAULT_TIMEOUT = (3, 10)
+
+# Max connections kept alive per host. Should match the size of the worker pool.
+POOL_SIZE = 32
+
+# Retries for GET/HEAD requests without side effects (opt-in, see `request`),
+# on connection errors, read timeouts and 502/503/504
+RETRIES = 2
+RETRY_BACKOFF = 0.2
+
+_sessions = {}
+_sessionsLock = threading.Lock()
+
+def configure(poolSize=None, timeout=None, retries=None):
+	"""
+	Change the default settings. Call it when the server starts, before sending any request.
+
+	:param poolSize: max connections kept alive per host. Optional.
+	:param timeout: default timeout, either a number or a (connect, read) tuple. Optional.
+	:param retries: default number of retries for requests that opt in. Optional.
+	:return:
+	"""
+	global POOL_SIZE, DEFAULT_TIMEOUT, RETRIES
+	if poolSize is not None:
+		POOL_SIZE = poolSize
+	if timeout is not None:
+		DEFAULT_TIMEOUT = timeout
+	if retries is not None:
+		RETRIES = retries
+
+def _retry(retries):
+	if retries == 0:
+		return 0
+	kwargs = {
+		"total": retries,
+		"backoff_factor": RETRY_BACKOFF,
+		"status_forcelist": (502, 503, 504),
+		"raise_on_status": False
+	}
+	try:
+		return Retry(allowed_methods=frozenset(("GET", "HEAD")), **kwargs)
+	except TypeError:
+		# urllib3 < 1.26
+		return Retry(method_whitelist=frozenset(("GET", "HEAD")), **kwargs)
+
+def getSession(url, retries=0):
+	"""
+	Return the keep-alive session used for `url`'s host
+
+	:param url: request url
+	:param retries: number of automatic retries of GET/HEAD requests. Default: 0.
+	:return: requests.Session
+	"""
+	parts = urlsplit(url)
+	key = (parts.scheme, parts.netloc, retries)
+	session = _sessions.get(key)
+	if session is None:
+		with _sessionsLock:
+			session = _sessions.get(key)
+			if session is None:
+				session = requests.Session()
+				adapter = requests.adapters.HTTPAdapter(
+					pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=_retry(retries)
+				)
+				session.mount("{}://".format(parts.scheme), adapter)
+				_sessions[key] = session
+	return session
+
+def _metric(kind, name, value, host):
+	# Clients such as schiavo may be used before the datadog client is ready
+	dog = getattr(glob, "dog", None)
+	if dog is not None:
+		getattr(dog, kind)(glob.DATADOG_PREFIX + ".http." + name, value, tags=["host:{}".format(host)])
+
+def request(method, url, timeout=None, retries=0, **kwargs):
+	"""
+	Send an http request through the host's keep-alive session.
+	Same arguments as `requests.request`.
+
+	:param method: http method
+	:param url: url
+	:param timeout: timeout. Optional. Default: DEFAULT_TIMEOUT.
+	:param retries: number of automatic retries, with backoff, if the request is a GET/HEAD.
+					Retries happen on read timeouts too, so only use it for requests without side effects
+					(`RETRIES` is the configured default for those). Default: 0.
+	:param kwargs: other `requests.request` arguments
+	:return: requests.Response
+	"""
+	host = urlsplit(url).netloc
+	start = time.perf_counter()
+	try:
+		response = getSession(url, retries).request(
+			method, url, timeout=timeout if timeout is not None else DEFAULT_TIMEOUT, **kwargs
+		)
+	except requests.RequestException:
+		_metric("increment", "errors", 1, host)
+		raise
+	finally:
+		_metric("histogram", "latency", time.perf_counter() - start, host)
+	if response.status_code >= 500:
+		_metric("increment", "errors", 1, host)
+	return response
+
+def get(url, **kwargs):
+	return request("GET", url, **kwargs)
+
+def post(url, **kwargs):
+	return request("POST", url, **kwargs)
@@ -0,0 +1,120 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common.log import logUtils as log
+from common.web.beatmapsCache import MISS, lruCache
+from objects import glob
+
+class listingEntry:
+	"""
+	A cached osu!direct listing: cheesegull's json, and its `toDirect` rendering once someone asks for it
+	"""
+	def __init__(self, data):
+		self.data = data
+		self.fetchedAt = time.time()
+		self.rendered = None
+
+class listingCache:
+	"""
+	Stale-while-revalidate cache of osu!direct listings.
+	Entries younger than `ttl` are served as they are.
+	Older entries are still served, but refreshed in the background,
+	until they're `maxStale` seconds old, then they're fetched again in the foreground.
+	Cached data is shared between callers, don't modify it.
+	"""
+	def __init__(self, ttl=60, maxStale=600, maxSize=1000, workers=2):
+		"""
+		:param ttl: seconds after which an entry is refreshed. Default: 60.
+		:param maxStale: seconds after which an entry is no longer served. Default: 600.
+		:param maxSize: max number of cached listings. Default: 1000.
+		:param workers: number of background refresh threads. Default: 2.
+		"""
+		self.ttl = ttl
+		self.maxStale = maxStale
+		self.entries = lruCache(maxSize)
+		self.workers = workers
+		self.refreshing = set()
+		self._executor = None
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def listingKey(rankedStatus, page, gameMode, query):
+		"""
+		Return the cache key of a listing.
+		Equivalent requests (eg: different query case or spacing) have the same key.
+
+		:param rankedStatus: cheesegull ranked status, list of ranked statuses or None
+		:param page: page (offset)
+		:param gameMode: game mode or None
+		:param query: search query
+		:return: key tuple
+		"""
+		if isinstance(rankedStatus, (list, tuple)):
+			rankedStatus = tuple(sorted(rankedStatus))
+		return (
+			rankedStatus,
+			int(page),
+			int(gameMode) if gameMode is not None else None,
+			normalizeQuery(query)
+		)
+
+	def _store(self, key, data):
+		entry = listingEntry(data)
+		self.entries.set(key, entry, self.maxStale)
+		return entry
+
+	def _refresh(self, key, fetch):
+		try:
+			data = fetch()
+			if data is not None:
+				self._store(key, data)
+		except Exception as e:
+			# Keep serving the stale entry
+			log.warning("Error while refreshing osu!direct listing {} ({})".format(key, e))
+		finally:
+			with self._lock:
+				self.refreshing.discard(key)
+
+	def _refreshInBackground(self, key, fetch):
+		with self._lock:
+			if key in self.refreshing:
+				return
+			self.refreshing.add(key)
+			if self._executor is None:
+				self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="listingCache")
+		self._executor.submit(self._refresh, key, fetch)
+
+	def get(self, key, fetch):
+		"""
+		Return the cached listing for `key`, calling `fetch()` if there's none
+
+		:param key: key returned by `listingKey`
+		:param fetch: function that returns the listing's json, or None if the request failed
+		:return: `listingEntry`, or None if there was nothing cached and `fetch()` failed
+		"""
+		entry = self.entries.get(key)
+		if entry is MISS:
+			glob.dog.increment(glob.DATADOG_PREFIX + ".listing_cache", tags=["result:miss"])
+			data = fetch()
+			if data is None:
+				return None
+			return self._store(key, data)
+		if time.time() - entry.fetchedAt < self.ttl:
+			glob.dog.increment(glob.DATADOG_PREFIX + ".listing_cache", tags=["result:fresh"])
+		else:
+			glob.dog.increment(glob.DATADOG_PREFIX + ".listing_cache", tags=["result:stale"])
+			self._refreshInBackground(key, fetch)
+		return entry
+
+def normalizeQuery(query):
+	"""
+	Lowercase a search query and collapse its whitespace
+
+	:param query: search query
+	:return: normalized query
+	"""
+	return " ".join((query or "").split()).lower()
+
+# Shared osu!direct listings cache
+cache = listingCache()
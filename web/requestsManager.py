@@ -1,13 +1,77 @@
 import contextlib
+import functools
+import inspect
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import tornado
 import tornado.web
 import tornado.gen
+import tornado.concurrent
 from tornado.ioloop import IOLoop
 from objects import glob
 from common.log import logUtils as log
 from raven.contrib.tornado import SentryMixin
 
+# Result passed to runBackground's callback when a request is shed by its bulkhead
+REQUEST_SHED = object()
+
+# Bulkheads by endpoint (MODULE_NAME). Endpoints without a bulkhead use glob.pool.
+bulkheads = {}
+
+# Optional prometheus histograms (with `method` and `endpoint` labels) in glob.stats,
+# used to split request latency by phase
+PHASE_STATS = {
+	"queueWait": "request_queue_wait_seconds",
+	"execution": "request_execution_seconds",
+	"callbackDelay": "request_callback_delay_seconds"
+}
+
+
+class requestTiming:
+	"""
+	Timestamps of the phases of a request handled in the background:
+	waiting for a thread (queue wait), running the handler (execution)
+	and waiting for the IOLoop to run the callback (callback delay)
+	"""
+	def __init__(self):
+		self.enqueued = time.monotonic()
+		self.started = None
+		self.finished = None
+		self.callbackRun = None
+
+	def wrap(self, func):
+		"""
+		Return a function that calls `func` and records when it starts and finishes
+
+		:param func: function
+		:return: wrapped function
+		"""
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			self.started = time.monotonic()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				self.finished = time.monotonic()
+		return wrapper
+
+	def phases(self):
+		"""
+		Return the duration of each phase
+
+		:return: dictionary {phase: seconds}, or None if the handler hasn't run (eg: shed request)
+		"""
+		if self.started is None or self.finished is None:
+			return None
+		return {
+			"queueWait": self.started - self.enqueued,
+			"execution": self.finished - self.started,
+			"callbackDelay": (self.callbackRun if self.callbackRun is not None else time.monotonic()) - self.finished
+		}
+
 
 class asyncRequestHandler(SentryMixin, tornado.web.RequestHandler):
 	"""
@@ -18,6 +82,9 @@ class asyncRequestHandler(SentryMixin, tornado.web.RequestHandler):
 	"""
 	MODULE_NAME = None
 
+	# Requests slower than this many seconds are logged with their phases breakdown. None to disable.
+	LATENCY_BUDGET = None
+
 	@property
 	def hasStats(self):
 		return self.MODULE_NAME is not None
@@ -34,22 +101,36 @@ class asyncRequestHandler(SentryMixin, tornado.web.RequestHandler):
 	def get(self, *args, **kwargs):
 		with self._getLatencyStat.time() if self.hasStats else contextlib.suppress():
 			with self._getInProgress.track_inprogress() if self.hasStats else contextlib.suppress():
+				timing = requestTiming()
 				try:
-					yield tornado.gen.Task(runBackground, (self.asyncGet, tuple(args), dict(kwargs)))
+					result = yield tornado.gen.Task(
+						runBackground, (self.asyncGet, tuple(args), dict(kwargs)),
+						endpoint=self.MODULE_NAME, timing=timing
+					)
+					if result is REQUEST_SHED:
+						self.sendShed()
 				finally:
 					if not self._finished:
 						self.finish()
+					self.reportTiming("get", timing)
 
 	@tornado.web.asynchronous
 	@tornado.gen.engine
 	def post(self, *args, **kwargs):
 		with self._postLatencyStat.time() if self.hasStats else contextlib.suppress():
 			with self._postInProgress.track_inprogress() if self.hasStats else contextlib.suppress():
+				timing = requestTiming()
 				try:
-					yield tornado.gen.Task(runBackground, (self.asyncPost, tuple(args), dict(kwargs)))
+					result = yield tornado.gen.Task(
+						runBackground, (self.asyncPost, tuple(args), dict(kwargs)),
+						endpoint=self.MODULE_NAME, timing=timing
+					)
+					if result is REQUEST_SHED:
+						self.sendShed()
 				finally:
 					if not self._finished:
 						self.finish()
+					self.reportTiming("post", timing)
 
 	def asyncGet(self, *args, **kwargs):
 		self.send_error(405)
@@ -57,6 +138,40 @@ class asyncRequestHandler(SentryMixin, tornado.web.RequestHandler):
 	def asyncPost(self, *args, **kwargs):
 		self.send_error(405)
 
+	def reportTiming(self, method, timing):
+		"""
+		Record the request phases in the phase histograms and log the request if it's over budget
+
+		:param method: `get` or `post`
+		:param timing: requestTiming object
+		:return:
+		"""
+		phases = timing.phases()
+		if phases is None:
+			return
+		if self.hasStats:
+			for phase, value in phases.items():
+				if PHASE_STATS[phase] in glob.stats:
+					glob.stats[PHASE_STATS[phase]].labels(method=method, endpoint=self.MODULE_NAME).observe(value)
+		total = sum(phases.values())
+		if self.LATENCY_BUDGET is not None and total > self.LATENCY_BUDGET:
+			log.warning(
+				"Slow request: {} {} ({}) took {:.3f}s (queue wait {:.3f}s, execution {:.3f}s, callback delay {:.3f}s)".format(
+					method.upper(), self.request.path, self.MODULE_NAME, total,
+					phases["queueWait"], phases["execution"], phases["callbackDelay"]
+				)
+			)
+
+	def sendShed(self):
+		"""
+		Reply with 503 and Retry-After, used when the endpoint's bulkhead is full
+
+		:return:
+		"""
+		self.set_status(503)
+		self.set_header("Retry-After", str(bulkheads[self.MODULE_NAME].retryAfter))
+		self.finish()
+
 	def getRequestIP(self):
 		real_ip = self.request.headers.get("X-Real-IP", None)
 		if real_ip is not None:
@@ -71,19 +186,248 @@ class asyncRequestHandler(SentryMixin, tornado.web.RequestHandler):
 		return self.request.remote_ip
 
 
-def runBackground(data, callback):
+class coroutineRequestHandler(asyncRequestHandler):
+	"""
+	Tornado request handler that supports native coroutines.
+	Same as asyncRequestHandler, but asyncGet() and asyncPost() can be `async def`:
+	in that case they run directly on the IOLoop, without going through the thread pool.
+	Blocking (non-async) asyncGet() and asyncPost() run in `EXECUTOR`
+	(a concurrent.futures executor, or None for the IOLoop's default one).
+	"""
+	EXECUTOR = None
+
+	async def get(self, *args, **kwargs):
+		with self._getLatencyStat.time() if self.hasStats else contextlib.suppress():
+			with self._getInProgress.track_inprogress() if self.hasStats else contextlib.suppress():
+				timing = requestTiming()
+				try:
+					await self.runHandler(self.asyncGet, args, kwargs, timing)
+				finally:
+					if not self._finished:
+						self.finish()
+					self.reportTiming("get", timing)
+
+	async def post(self, *args, **kwargs):
+		with self._postLatencyStat.time() if self.hasStats else contextlib.suppress():
+			with self._postInProgress.track_inprogress() if self.hasStats else contextlib.suppress():
+				timing = requestTiming()
+				try:
+					await self.runHandler(self.asyncPost, args, kwargs, timing)
+				finally:
+					if not self._finished:
+						self.finish()
+					self.reportTiming("post", timing)
+
+	async def runHandler(self, func, args, kwargs, timing=None):
+		"""
+		Await `func` if it's a coroutine function, otherwise run it in `EXECUTOR`
+
+		:param func: handler function
+		:param args: positional arguments
+		:param kwargs: keyword arguments
+		:param timing: requestTiming object that records the request phases. Optional.
+		:return: `func`'s return value
+		"""
+		glob.dog.increment(glob.DATADOG_PREFIX + ".incoming_requests")
+		if timing is None:
+			timing = requestTiming()
+		try:
+			if inspect.iscoroutinefunction(func):
+				# Runs on the IOLoop, there's no queue wait nor callback delay
+				timing.started = timing.enqueued = time.monotonic()
+				try:
+					return await func(*args, **kwargs)
+				finally:
+					timing.finished = time.monotonic()
+			func = timing.wrap(func)
+			if self.MODULE_NAME in bulkheads:
+				future = tornado.concurrent.Future()
+				loop = IOLoop.current()
+				bulkheads[self.MODULE_NAME].submit(
+					func, args, kwargs, lambda result: loop.add_callback(future.set_result, result)
+				)
+				result = await future
+				if result is REQUEST_SHED:
+					self.sendShed()
+				return result
+			return await IOLoop.current().run_in_executor(self.EXECUTOR, functools.partial(func, *args, **kwargs))
+		finally:
+			timing.callbackRun = time.monotonic()
+
+	async def asyncGet(self, *args, **kwargs):
+		self.send_error(405)
+
+	async def asyncPost(self, *args, **kwargs):
+		self.send_error(405)
+
+
+class bulkheadJob:
+	"""
+	A request queued in a bulkhead.
+	Either a worker thread starts it or the deadline timeout sheds it, whichever comes first.
+	"""
+	PENDING = 0
+	RUNNING = 1
+	SHED = 2
+
+	def __init__(self, func, args, kwargs, callback):
+		self.func = func
+		self.args = args
+		self.kwargs = kwargs
+		self.callback = callback
+		self.enqueuedAt = time.monotonic()
+		self.state = bulkheadJob.PENDING
+		self.timeout = None
+
+class bulkhead:
+	"""
+	A dedicated, bounded thread pool for an endpoint.
+	Requests that find the queue full, or that wait in the queue for longer
+	than the deadline, are shed (callback receives REQUEST_SHED) instead of being processed.
+	Deadlines are enforced by an IOLoop timeout, so requests are shed on time even when all threads are busy.
+	"""
+	def __init__(self, name, concurrency, maxQueue=None, deadline=None, retryAfter=1):
+		"""
+		Initialize a bulkhead
+
+		:param name: endpoint name (MODULE_NAME)
+		:param concurrency: max number of requests processed at the same time
+		:param maxQueue: max number of requests waiting for a thread. Optional. Default: no limit.
+		:param deadline: max seconds a request can wait for a thread. Optional. Default: no limit.
+		:param retryAfter: Retry-After header value (seconds) of shed requests. Default: 1.
+		"""
+		self.name = name
+		self.maxQueue = maxQueue
+		self.deadline = deadline
+		self.retryAfter = retryAfter
+		self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bulkhead-{}".format(name))
+		self.queued = 0
+		self.shed = 0
+		self._lock = threading.Lock()
+
+	def _reportQueued(self, queued):
+		glob.dog.gauge(glob.DATADOG_PREFIX + ".bulkhead.queued", queued, tags=["endpoint:{}".format(self.name)])
+
+	def _dequeue(self, job, state):
+		"""
+		Move a pending job to `state`
+
+		:param job: bulkheadJob
+		:param state: bulkheadJob.RUNNING or bulkheadJob.SHED
+		:return: True if the job was pending, False if it has already been started or shed
+		"""
+		with self._lock:
+			if job.state != bulkheadJob.PENDING:
+				return False
+			job.state = state
+			self.queued -= 1
+			queued = self.queued
+		self._reportQueued(queued)
+		return True
+
+	def _shed(self, callback, reason):
+		self.shed += 1
+		glob.dog.increment(
+			glob.DATADOG_PREFIX + ".bulkhead.shed",
+			tags=["endpoint:{}".format(self.name), "reason:{}".format(reason)]
+		)
+		callback(REQUEST_SHED)
+
+	def submit(self, func, args, kwargs, callback):
+		"""
+		Run `func` in this bulkhead's threads, or shed it
+
+		:param func: function
+		:param args: positional arguments
+		:param kwargs: keyword arguments
+		:param callback: function called with `func`'s return value, or with REQUEST_SHED.
+						 It may be called from any thread.
+		:return:
+		"""
+		with self._lock:
+			if self.maxQueue is not None and self.queued >= self.maxQueue:
+				full = True
+			else:
+				full = False
+				self.queued += 1
+				queued = self.queued
+		if full:
+			self._shed(callback, "queue")
+			return
+		self._reportQueued(queued)
+		job = bulkheadJob(func, args, kwargs, callback)
+		if self.deadline is not None:
+			loop = IOLoop.current()
+			job.timeout = (loop, loop.call_later(self.deadline, self._expire, job))
+		self.executor.submit(self._run, job)
+
+	def _expire(self, job):
+		# Runs on the IOLoop when the deadline passes
+		if self._dequeue(job, bulkheadJob.SHED):
+			self._shed(job.callback, "deadline")
+
+	def _run(self, job):
+		if self.deadline is not None and time.monotonic() - job.enqueuedAt > self.deadline:
+			# The IOLoop timeout is late (or already shed it)
+			if self._dequeue(job, bulkheadJob.SHED):
+				self._shed(job.callback, "deadline")
+			return
+		if not self._dequeue(job, bulkheadJob.RUNNING):
+			return
+		if job.timeout is not None:
+			loop, timeout = job.timeout
+			loop.add_callback(loop.remove_timeout, timeout)
+		result = None
+		try:
+			result = job.func(*job.args, **job.kwargs)
+		except:
+			log.error("Unhandled exception in bulkhead {}!\n```\n{}```".format(self.name, traceback.format_exc()))
+		finally:
+			job.callback(result)
+
+def configureBulkhead(endpoint, concurrency, maxQueue=None, deadline=None, retryAfter=1):
+	"""
+	Give an endpoint its own bounded thread pool, instead of glob.pool.
+	Call it when the server starts.
+
+	:param endpoint: endpoint name (MODULE_NAME)
+	:param concurrency: max number of requests processed at the same time
+	:param maxQueue: max number of requests waiting for a thread. Optional. Default: no limit.
+	:param deadline: max seconds a request can wait for a thread. Optional. Default: no limit.
+	:param retryAfter: Retry-After header value (seconds) of shed requests. Default: 1.
+	:return: the bulkhead
+	"""
+	bulkheads[endpoint] = bulkhead(endpoint, concurrency, maxQueue, deadline, retryAfter)
+	return bulkheads[endpoint]
+
+def runBackground(data, callback, endpoint=None, timing=None):
 	"""
 	Run a function in the background.
 	Used to handle multiple requests at the same time
 
 	:param data: (func, args, kwargs)
-	:param callback: function to call when `func` (data[0]) returns
+	:param callback: function to call when `func` (data[0]) returns.
+					 Called with REQUEST_SHED if `endpoint`'s bulkhead sheds the request.
+	:param endpoint: endpoint name. If it has a bulkhead, `func` runs there instead of glob.pool. Optional.
+	:param timing: requestTiming object that records the request phases. Optional.
 	:return:
 	"""
 	func, args, kwargs = data
+	if timing is not None:
+		timing.enqueued = time.monotonic()
+		func = timing.wrap(func)
+
+	def _runCallback(result):
+		if timing is not None:
+			timing.callbackRun = time.monotonic()
+		callback(result)
+
 	def _callback(result):
-		IOLoop.instance().add_callback(lambda: callback(result))
-	glob.pool.apply_async(func, args, kwargs, _callback)
+		IOLoop.instance().add_callback(lambda: _runCallback(result))
+	if endpoint in bulkheads:
+		bulkheads[endpoint].submit(func, args, kwargs, _callback)
+	else:
+		glob.pool.apply_async(func, args, kwargs, _callback)
 	glob.dog.increment(glob.DATADOG_PREFIX + ".incoming_requests")
 
 def checkArguments(arguments, requiredArguments):
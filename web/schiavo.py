@@ -1,6 +1,8 @@
 import requests
 from urllib.parse import urlencode
 
+from common.web import httpClient
+
 class schiavo:
 	"""
 	Schiavo Bot class
@@ -31,7 +33,7 @@ class schiavo:
 		for _ in range(0, self.maxRetries):
 			try:
 				finalMsg = "{prefix} {message}".format(prefix=self.prefix if not noPrefix else "", message=message)
-				requests.get("{}/{}?{}".format(self.botURL, channel, urlencode({ "message": finalMsg })))
+				httpClient.get("{}/{}?{}".format(self.botURL, channel, urlencode({ "message": finalMsg })))
 				break
 			except requests.RequestException:
 				continue
@@ -0,0 +1,75 @@
+import asyncio
+import concurrent.futures
+import threading
+
+class singleFlight:
+	"""
+	Deduplicates concurrent identical calls.
+	While a call for a key is in flight, other callers with the same key
+	wait for it and get the same result (or the same exception) instead of running it again.
+	Works from threads (`do`) and from coroutines (`doAsync`), sharing the same in flight calls.
+	"""
+	def __init__(self, timeout=15):
+		"""
+		:param timeout: max seconds a caller waits for someone else's call. Default: 15.
+		"""
+		self.timeout = timeout
+		self.calls = {}
+		self._lock = threading.Lock()
+
+	def _join(self, key):
+		"""
+		Return the in flight call for `key`, registering a new one if there's none
+
+		:param key: call key
+		:return: (future, leader). If `leader` is True, the caller must run the call with `_run`.
+		"""
+		with self._lock:
+			future = self.calls.get(key)
+			if future is not None:
+				return future, False
+			future = concurrent.futures.Future()
+			self.calls[key] = future
+			return future, True
+
+	def _run(self, key, future, func, args, kwargs):
+		try:
+			future.set_result(func(*args, **kwargs))
+		except BaseException as e:
+			future.set_exception(e)
+		finally:
+			with self._lock:
+				self.calls.pop(key, None)
+
+	def do(self, key, func, *args, **kwargs):
+		"""
+		Call `func(*args, **kwargs)`, or wait for an identical in flight call
+
+		:param key: hashable call key
+		:param func: function to call
+		:return: `func`'s return value
+		:raises concurrent.futures.TimeoutError: if someone else's call didn't complete in time
+		"""
+		future, leader = self._join(key)
+		if leader:
+			self._run(key, future, func, args, kwargs)
+		return future.result(timeout=None if leader else self.timeout)
+
+	async def doAsync(self, key, func, *args, executor=None, **kwargs):
+		"""
+		Same as `do`, but `func` runs in `executor` and the caller awaits its result.
+
+		:param key: hashable call key
+		:param func: blocking function to call
+		:param executor: executor that runs `func`. Optional. Default: the event loop's default executor.
+		:return: `func`'s return value
+		:raises concurrent.futures.TimeoutError: if the call didn't complete in time
+		"""
+		future, leader = self._join(key)
+		if leader:
+			asyncio.get_event_loop().run_in_executor(executor, self._run, key, future, func, args, kwargs)
+		try:
+			# shield, so a timed out waiter doesn't cancel the call for everyone else
+			return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.timeout)
+		except asyncio.TimeoutError:
+			raise concurrent.futures.TimeoutError()